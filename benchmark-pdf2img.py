@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# Benchmark of pdf2img.py on synthetic PDFs. Every case exercises one way of
+# extracting or generating page images, and is converted with every output
+# format and number of processes. Results are saved as JSON, so runs of
+# different versions can be compared with --compare.
+import argparse
+import datetime
+import hashlib
+from io import BytesIO
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import fitz
+from PIL import Image, ImageChops, ImageCms, ImageDraw, ImageOps
+import pillow_jxl
+
+PDF2IMG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf2img.py')
+# Resolution of the synthetic images
+IMAGE_DPI = 300
+FORMATS = {'webp': [], 'jxl': ['save-jxl'], 'png': ['save-png']}
+# Options of the cases that need them. A clipped jpeg must not be passed
+# through as it is. Parts of a split page that land on the same worker must
+# not strip the page twice.
+CASE_OPTIONS = {'clip-jpeg': ['passthrough-jpeg'],
+                'split-multi': ['split-pages', 'band-height 500']}
+# Pixels of an output image that differ from MuPDF's rendering of the page by
+# more than REFERENCE_TOLERANCE in a channel. Resampling and anti-aliasing
+# differ a little, a missing clipping path or image differs a lot.
+REFERENCE_TOLERANCE = 48
+REFERENCE_MAX_DIFFERENCE = 0.01
+
+def make_rgb_image(size, seed):
+    # Gradients with a grid of shapes, different for every page
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    radial = Image.radial_gradient('L').resize(size)
+    image = Image.merge('RGB', (gradient, radial, ImageOps.invert(gradient)))
+    draw = ImageDraw.Draw(image)
+    step = max(min(size) // 12, 8)
+    for y in range(0, height, step):
+        for x in range(0, width, step):
+            shade = (x * 7 + y * 13 + seed * 31) % 256
+            box = (x + step // 8, y + step // 8, x + step * 7 // 8, y + step * 7 // 8)
+            if (x // step + y // step + seed) % 3 == 0:
+                draw.ellipse(box, fill=(shade, 255 - shade, (shade * 3) % 256))
+            elif (x // step + y // step + seed) % 3 == 1:
+                draw.rectangle(box, outline=(0, 0, 0), width=max(step // 16, 1))
+            else:
+                draw.line(box, fill=(255 - shade, shade, 0), width=max(step // 10, 1))
+    return image
+
+def jpeg_bytes(image, **params):
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=90, **params)
+    return buffer.getvalue()
+
+def add_stream(doc, dictionary, data):
+    xref = doc.get_new_xref()
+    doc.update_object(xref, '<<>>')
+    doc.update_stream(xref, data, new=True, compress=False)
+    # Written after the stream, update_stream() drops /Filter
+    doc.update_object(xref, f'<<{dictionary}>>')
+    return xref
+
+def add_image(doc, page, name, size, dictionary, data):
+    xref = add_stream(doc, f'/Type/XObject/Subtype/Image/Width {size[0]}/Height {size[1]}{dictionary}', data)
+    # new_page() makes /Resources an indirect object, which xref_set_key()
+    # cannot set a path through
+    resources_type, resources = doc.xref_get_key(page.xref, 'Resources')
+    if resources_type == 'xref':
+        doc.xref_set_key(int(resources.split()[0]), f'XObject/{name}', f'{xref} 0 R')
+    else:
+        doc.xref_set_key(page.xref, f'Resources/XObject/{name}', f'{xref} 0 R')
+    return xref
+
+def set_contents(doc, page, content):
+    xref = add_stream(doc, '/Filter/FlateDecode', zlib.compress(content.encode('ascii')))
+    doc.xref_set_key(page.xref, 'Contents', f'{xref} 0 R')
+
+def image_dictionary(kind, doc, image):
+    # Image XObject entries and data of each kind of image
+    if kind == 'dct-rgb':
+        return '/ColorSpace/DeviceRGB/BitsPerComponent 8/Filter/DCTDecode', jpeg_bytes(image)
+    if kind == 'dct-cmyk':
+        return '/ColorSpace/DeviceCMYK/BitsPerComponent 8/Filter/DCTDecode', jpeg_bytes(image.convert('CMYK'))
+    if kind == 'dct-icc':
+        profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        icc_xref = add_stream(doc, '/N 3/Filter/FlateDecode', zlib.compress(profile))
+        return f'/ColorSpace[/ICCBased {icc_xref} 0 R]/BitsPerComponent 8/Filter/DCTDecode', jpeg_bytes(image)
+    if kind == 'imagemask':
+        return '/ImageMask true/BitsPerComponent 1/Filter/FlateDecode', zlib.compress(image.convert('1').tobytes())
+    if kind == 'mono':
+        return '/ColorSpace/DeviceGray/BitsPerComponent 1/Filter/FlateDecode', zlib.compress(image.convert('1').tobytes())
+    if kind == 'gray':
+        return '/ColorSpace/DeviceGray/BitsPerComponent 8/Filter/FlateDecode', zlib.compress(image.convert('L').tobytes())
+    return '/ColorSpace/DeviceRGB/BitsPerComponent 8/Filter/FlateDecode', zlib.compress(image.tobytes())
+
+def build_page(doc, case, size, pagenum):
+    width, height = size
+    if case == 'split-multi':
+        # Tall enough to be split into parts that take a while
+        height *= 4
+    page_width = width * 72 / IMAGE_DPI
+    page_height = height * 72 / IMAGE_DPI
+    page = doc.new_page(width=page_width, height=page_height)
+    if case == 'no-image':
+        set_contents(doc, page, '')
+    elif case in ('multi', 'split-multi'):
+        # A grid of 2x2 images of different kinds
+        content = ''
+        for index, kind in enumerate(('rgb', 'gray', 'dct-rgb', 'mono')):
+            dictionary, data = image_dictionary(kind, doc, make_rgb_image((width // 2, height // 2), pagenum * 4 + index))
+            add_image(doc, page, f'Im{index}', (width // 2, height // 2), dictionary, data)
+            x = page_width / 2 * (index % 2)
+            y = page_height / 2 * (1 - index // 2)
+            content += f'q {page_width / 2} 0 0 {page_height / 2} {x} {y} cm /Im{index} Do Q\n'
+        set_contents(doc, page, content)
+    else:
+        kind = {'clip': 'rgb', 'clip-jpeg': 'dct-rgb', 'overlay': 'rgb'}.get(case, case)
+        dictionary, data = image_dictionary(kind, doc, make_rgb_image(size, pagenum))
+        add_image(doc, page, 'Im0', size, dictionary, data)
+        content = f'q {page_width} 0 0 {page_height} 0 0 cm /Im0 Do Q\n'
+        if case in ('clip', 'clip-jpeg'):
+            # Triangle clipping path
+            content = f'q 0 0 m {page_width} 0 l {page_width / 2} {page_height} l h W n\n{content}Q\n'
+        elif case == 'imagemask':
+            # pdf2img pastes masks in black, whatever the fill color
+            content = f'0 g\n{content}'
+        set_contents(doc, page, content)
+    if case in ('overlay', 'no-image'):
+        # Vector drawings and text over the page
+        rect = page.rect
+        page.draw_rect(fitz.Rect(rect.width * 0.1, rect.height * 0.1, rect.width * 0.9, rect.height * 0.3),
+                       color=(1, 0, 0), fill=(1, 1, 0.8), width=2)
+        page.draw_circle(fitz.Point(rect.width / 2, rect.height * 0.6), rect.width * 0.2, color=(0, 0, 1), width=3)
+        page.insert_text(fitz.Point(rect.width * 0.15, rect.height * 0.2), f'pdf2img benchmark {pagenum + 1}',
+                         fontsize=rect.width / 20, fontname='helv')
+
+CASES = ('dct-rgb', 'dct-cmyk', 'dct-icc', 'imagemask', 'mono', 'gray', 'rgb', 'clip', 'clip-jpeg', 'multi', 'split-multi', 'overlay', 'no-image')
+
+def build_pdf(filename, case, size, page_count):
+    doc = fitz.open()
+    for pagenum in range(page_count):
+        build_page(doc, case, size, pagenum)
+    doc.save(filename, garbage=1)
+    doc.close()
+
+def pixel_digest(filename):
+    # Digest of the decoded pixels, so outputs can be compared across encoder
+    # versions and formats
+    with Image.open(filename) as image:
+        image.load()
+        sha256 = hashlib.sha256(f'{image.mode} {image.size}'.encode('ascii'))
+        sha256.update(image.tobytes())
+    return sha256.hexdigest()
+
+def reference_difference(pdf_filename, pagenum, filename):
+    # Part of the pixels of an output image that differ clearly from MuPDF's
+    # rendering of the page at the same size
+    with Image.open(filename) as image:
+        image.load()
+        image = image.convert('L' if image.mode in ('1', 'L', 'LA') else 'RGB')
+    if image.mode == 'RGB':
+        # webp stores gray images as RGB
+        red, green, blue = image.split()
+        if ImageChops.difference(red, green).getbbox() is None and ImageChops.difference(green, blue).getbbox() is None:
+            image = red
+    mode = image.mode
+    with fitz.open(pdf_filename) as doc:
+        page = doc[pagenum]
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(image.width / page.rect.width, image.height / page.rect.height),
+                                 colorspace=fitz.csGRAY if mode == 'L' else fitz.csRGB, alpha=False)
+    rendering = Image.frombytes(mode, (pixmap.width, pixmap.height), pixmap.samples)
+    if rendering.size != image.size:
+        rendering = rendering.resize(image.size)
+    difference = ImageChops.difference(image, rendering)
+    if mode == 'RGB':
+        red, green, blue = difference.split()
+        difference = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    return sum(difference.histogram()[REFERENCE_TOLERANCE:]) / (image.width * image.height)
+
+def measure(command, env, cwd):
+    # Run the command in a child that reports the peak memory of the largest
+    # of its processes
+    child = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', '--'] + command,
+                           env=env, cwd=cwd, stdout=subprocess.PIPE, text=True)
+    lines = child.stdout.strip().split('\n')
+    try:
+        return json.loads(lines[-1])
+    except ValueError:
+        print(child.stdout)
+        return {'returncode': child.returncode, 'peak_rss': None}
+
+def run_measured(command):
+    returncode = subprocess.run(command).returncode
+    peak_rss = None
+    if resource is not None:
+        # Kilobytes on Linux, bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    print(json.dumps({'returncode': returncode, 'peak_rss': peak_rss}))
+
+def run_case(work_dir, pdf, case, output_format, processes, page_count):
+    # pdf is the name of the pdf in work_dir
+    work_dir = os.path.abspath(work_dir)
+    name = f'{case}-{output_format}-{processes}'
+    config_filename = os.path.join(work_dir, f'config-{name}.txt')
+    with open(config_filename, 'w', encoding='utf-8') as f:
+        f.write(f'processes {processes}\n')
+        for option in FORMATS[output_format] + CASE_OPTIONS.get(case, []):
+            f.write(f'{option}\n')
+    output_dir = os.path.join(work_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+    env = dict(os.environ, PDF2IMG_CONFIG=config_filename, PDF2IMG_OUTPUT=output_dir)
+    start = time.perf_counter()
+    measured = measure([sys.executable, PDF2IMG, pdf, '--overwrite'], env, work_dir)
+    seconds = time.perf_counter() - start
+    # pdf2img writes into <PDF2IMG_OUTPUT>/<pdf>-img
+    image_dir = os.path.join(output_dir, pdf + '-img')
+    digests = {}
+    differences = {}
+    if os.path.isdir(image_dir):
+        for filename in sorted(os.listdir(image_dir)):
+            if not filename.endswith('.jsonl'):
+                digests[filename] = pixel_digest(os.path.join(image_dir, filename))
+                # Named after the page, 001.webp
+                differences[filename] = reference_difference(os.path.join(work_dir, pdf), int(filename[:3]) - 1,
+                                                             os.path.join(image_dir, filename))
+    return {'case': case,
+            'format': output_format,
+            'processes': processes,
+            'pages': page_count,
+            'returncode': measured['returncode'],
+            'seconds': seconds,
+            'pages_per_second': page_count / seconds,
+            'peak_rss': measured['peak_rss'],
+            'digests': digests,
+            'reference_differences': differences}
+
+def compare_results(results, reference):
+    # Every page must be written and look like MuPDF's rendering of it.
+    # Outputs must not depend on the number of processes, and must match the
+    # reference run pixel by pixel.
+    mismatches = []
+    expected = {}
+    for result in reference.get('results', []) if reference else []:
+        expected.setdefault((result['case'], result['format']), result['digests'])
+    for result in results:
+        key = (result['case'], result['format'])
+        if len(result['digests']) != result['pages']:
+            mismatches.append(f"{result['case']} {result['format']} {result['processes']}個進程："
+                              f"{result['pages']}頁只輸出{len(result['digests'])}個檔案")
+            continue
+        for filename, difference in result['reference_differences'].items():
+            if difference > REFERENCE_MAX_DIFFERENCE:
+                mismatches.append(f"{result['case']} {result['format']} {result['processes']}個進程：{filename}"
+                                  f"與渲染結果有{difference:.1%}的像素不同")
+        if key not in expected:
+            expected[key] = result['digests']
+        elif result['digests'] != expected[key]:
+            mismatches.append(f"{result['case']} {result['format']} {result['processes']}個進程")
+    return mismatches
+
+def print_result(result):
+    peak = f"{result['peak_rss'] / 2**20:.0f} MB" if result['peak_rss'] else '-'
+    status = '' if result['returncode'] == 0 else f"  結束代碼{result['returncode']}"
+    print(f"{result['case']:<12}{result['format']:<6}{result['processes']:3}個進程"
+          f"{result['pages_per_second']:8.2f} 頁/秒  {peak:>8}{status}")
+
+def main():
+    parser = argparse.ArgumentParser(description='以合成的PDF檔測試pdf2img.py的轉換速度及記憶體用量')
+    parser.add_argument('--work-dir', default='benchmark-pdf2img',
+                        help='產生PDF檔及輸出圖片的資料夾')
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='要測試的項目，以逗號分隔：' + ','.join(CASES))
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help='要測試的輸出格式，以逗號分隔')
+    parser.add_argument('--processes', default='1,2,4',
+                        help='要測試的進程數，以逗號分隔')
+    parser.add_argument('--pages', type=int, default=8,
+                        help='每個PDF檔的頁數')
+    parser.add_argument('--size', default='2480x3508',
+                        help='合成圖片的尺寸（像素）')
+    parser.add_argument('--results',
+                        help='結果的JSON檔，預設為資料夾中以時間命名的檔案')
+    parser.add_argument('--compare',
+                        help='與先前結果的JSON檔比較輸出圖片的像素')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('command', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        run_measured(args.command)
+        return
+
+    size = tuple(int(number) for number in args.size.split('x'))
+    os.makedirs(args.work_dir, exist_ok=True)
+    reference = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            reference = json.load(f)
+
+    results = []
+    for case in args.cases.split(','):
+        pdf = f'{case}.pdf'
+        build_pdf(os.path.join(args.work_dir, pdf), case, size, args.pages)
+        for output_format in args.formats.split(','):
+            for processes in args.processes.split(','):
+                result = run_case(args.work_dir, pdf, case, output_format, int(processes), args.pages)
+                print_result(result)
+                results.append(result)
+
+    results_filename = args.results or os.path.join(
+        args.work_dir, f"results-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(results_filename, 'w', encoding='utf-8') as f:
+        json.dump({'date': datetime.datetime.now().isoformat(),
+                   'python': sys.version,
+                   'pymupdf': fitz.VersionBind,
+                   'pillow': Image.__version__,
+                   'size': size,
+                   'results': results},
+                  f, ensure_ascii=False, indent=1)
+    print(f'結果已寫入{results_filename}')
+
+    mismatches = compare_results(results, reference)
+    for mismatch in mismatches:
+        print(f'輸出圖片不一致：{mismatch}')
+    if mismatches or any(result['returncode'] != 0 for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,114 @@
 #!/usr/bin/env python3
-from concurrent.futures import ProcessPoolExecutor
+import argparse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import csv
+import hashlib
+import heapq
 from io import BytesIO
-from itertools import repeat
+import json
 import math
 import multiprocessing
 import os
+import re
+import shutil
 import signal
+import struct
 import sys
+import tarfile
 import threading
-import tkinter
-import tkinter.filedialog
-import tkinter.messagebox
-from tkinter import ttk
+import time
 import traceback
+import zipfile
+import zlib
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
 
-import cairo
 import fitz
-from PIL import Image, ImageOps
-import pillow_jxl
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+DOCUMENT_CACHE_SIZE = 4
+# Image pages looked at to find the scan resolution of a document
+RENDER_ZOOM_SAMPLES = 32
+# Zoom of the probe rendering of pages without images, 72 dpi
+PROBE_ZOOM = 1
+# Probe pixels lighter than this are paper
+BLANK_THRESHOLD = 250
+# Largest difference between the channels of a gray probe pixel
+COLOR_THRESHOLD = 24
+# Fraction of probe pixels in flat gray areas that 1-bit would lose
+MONO_MAX_GRAY = 0.001
+MAX_CHUNK_PAGES = 16
+# Times a page is retried after the process converting it was killed
+MAX_RETRIES = 2
+# Seconds the service mode waits for new jobs before checking again
+JOB_POLL_INTERVAL = 0.5
+# Seconds between scans of the watched directory
+WATCH_INTERVAL = 2
+# Written to every output directory, one json line per finished page
+MANIFEST_NAME = 'pdf2img-manifest.jsonl'
+# Options that change the output of each kind of page, a page is converted
+# again on the next run only if one of them changed
+PAGE_OPTIONS = {'extract': ('only-extract', 'save-jxl', 'save-png'),
+                'render': ('only-extract', 'prefer-mono', 'save-jxl', 'save-png', 'render-dpi', 'adaptive-render'),
+                'render-fallback': ('only-extract', 'render-image', 'no-crop', 'original-only', 'extract-jpeg',
+                                    'prefer-mono', 'save-jxl', 'save-png', 'passthrough-jpeg'),
+                'composite': ('only-extract', 'render-image', 'no-crop', 'original-only', 'extract-jpeg',
+                              'prefer-mono', 'save-jxl', 'save-png', 'passthrough-jpeg'),
+                'passthrough': ('only-extract', 'render-image', 'no-crop', 'original-only', 'extract-jpeg',
+                                'prefer-mono', 'save-jxl', 'save-png', 'passthrough-jpeg'),
+                }
+FORMAT_OPTIONS = {'.webp': ('webp-method', 'webp-quality'),
+                  '.jxl': ('jxl-effort',),
+                  '.png': ('png-compress-level',),
+                  }
+# Largest size of webp images
+WEBP_MAX_SIZE = 16383
+ARCHIVE_FORMATS = ('cbz', 'zip', 'tar')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Bit depth and color type of the modes written by write_png_bands()
+PNG_FORMATS = {'1': (1, 0), 'L': (8, 0), 'RGB': (8, 2)}
+
+PageLayout = namedtuple('PageLayout', ['zoom', 'matrices', 'rects', 'rect_merge', 'size', 'mode', 'is_mono', 'warnings'])
+PDF_WHITESPACE = b'\x00\t\n\x0c\r '
+PDF_REFERENCE = re.compile(rb'(\d+)\s+\d+\s+R\b')
+# Keys of a page that make up how it looks, besides its boxes and rotation
+PAGE_CONTENT_KEYS = ('Contents', 'Resources', 'Annots', 'Group')
+CONTENT_TOKEN = re.compile(rb'[\x00\t\n\x0c\r ]+|%[^\r\n]*|/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*|<<|>>|<[^>]*>|[\[\]{}(]|[^\x00\t\n\x0c\r ()<>\[\]{}/%]+')
+LITERAL_STRING_SPECIAL = re.compile(rb'[()\\]')
+INLINE_IMAGE_END = re.compile(rb'[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r /]|$)')
+# First characters of operands, anything else is an operator
+CONTENT_OPERAND_START = b'/<[]{}()+-.0123456789'
+# Path construction operators and their number of operands
+PATH_OPERATORS = {b'm': 2, b'l': 2, b'c': 6, b'v': 4, b'y': 4, b're': 4, b'h': 0}
+PAINT_OPERATORS = (b'n', b'f', b'F', b'f*', b'B', b'B*', b'b', b'b*', b'S', b's')
+# Threshold of prefer-mono, i > 127
+MONO_LUT = [0] * 128 + [255] * 128
+# Kinds of get_bboxlog() entries that leave marks on the overlay
+OVERLAY_DRAWING_KINDS = ('fill-path', 'stroke-path', 'fill-text', 'stroke-text', 'fill-shade', 'fill-imgmask')
+
+ImageInfo = namedtuple('ImageInfo', ['xref', 'width', 'height', 'cs_type', 'cs', 'filter', 'image_mask', 'bits', 'decode'])
+ImageDraw = namedtuple('ImageDraw', ['offset', 'ctm', 'clips', 'depth'])
+ContentIndex = namedtuple('ContentIndex', ['xrefs', 'streams', 'draws', 'fills'])
+PagePlan = namedtuple('PagePlan', ['pagenum', 'kind', 'pixels', 'size', 'mode', 'zoom', 'memory'])
+# part is (index, count) of a page converted by several workers, otherwise None
+# source is the checksum of the file
+Task = namedtuple('Task', ['file', 'source', 'pagenums', 'output_dir', 'references', 'render_zoom', 'part', 'memory'])
+
 
+# Files written and profile of the page being converted in a worker, see
+# convert_page()
+page_outputs = None
+page_stats = None
+worker_init_cpu = None
+# Process that imported this module, a forked worker has the parent's imports
+import_pid = os.getpid()
 
 def read_config():
     config = {'processes': 2,
@@ -31,6 +120,25 @@ def read_config():
               'prefer-mono': False,
               'save-jxl': False,
               'save-png': False,
+              'passthrough-jpeg': False,
+              'split-pages': False,
+              'dedupe': False,
+              'decode-threads': 1,
+              'render-dpi': 600,
+              'adaptive-render': False,
+              'image-cache': 128,
+              'encode-processes': 0,
+              'encode-memory': 1024,
+              'webp-method': 4,
+              'webp-quality': 80,
+              'jxl-effort': 7,
+              'png-compress-level': 6,
+              'memory-limit': 0,
+              'band-height': 4096,
+              'overwrite': False,
+              'archive': None,
+              'archive-memory': 512,
+              'profile': False,
               }
     try:
         if 'PDF2IMG_CONFIG' in os.environ:
@@ -64,31 +172,256 @@ def read_config():
                 config['save-jxl'] = True
             elif option[0] == 'save-png':
                 config['save-png'] = True
+            elif option[0] == 'passthrough-jpeg':
+                config['passthrough-jpeg'] = True
+            elif option[0] == 'dedupe':
+                config['dedupe'] = True
+            elif option[0] == 'split-pages':
+                config['split-pages'] = True
+            elif option[0] == 'adaptive-render':
+                config['adaptive-render'] = True
+            elif option[0] == 'overwrite':
+                config['overwrite'] = True
+            elif option[0] == 'archive':
+                if option[1] in ARCHIVE_FORMATS:
+                    config['archive'] = option[1]
+                else:
+                    print(f'警告：不支援的壓縮檔格式：{option[1]}')
+            elif option[0] == 'image-cache':
+                config['image-cache'] = int(option[1])
+            elif option[0] in ('decode-threads', 'render-dpi', 'memory-limit', 'band-height', 'archive-memory', 'encode-processes', 'encode-memory', 'webp-method', 'webp-quality', 'jxl-effort', 'png-compress-level'):
+                config[option[0]] = int(option[1])
     except FileNotFoundError:
         print('警告：找不到設定檔')
     except Exception:
         print(traceback.format_exc())
     return config
 
-def get_referencer_of_image(image, page):
-    ref = image[9]
-    if ref == 0:
-        # Image is directly referenced by the page
-        return page.get_contents()[0]
-    else:
-        return ref
+def read_peak_rss():
+    # Peak resident memory of this process in bytes since reset_peak_rss(),
+    # or since the process started where it cannot be reset
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    # Kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
 
-def remove_path_fill(doc, page):
-    images = page.get_images(full=True)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def start_page_stats(config):
+    global page_stats
+    global worker_init_cpu
+    if not config['profile']:
+        page_stats = None
+        return
+    reset_peak_rss()
+    page_stats = {'pid': os.getpid(),
+                  'path': None,
+                  'pixels': 0,
+                  'stages': {},
+                  'frames': [{'wall': 0.0, 'cpu': 0.0, 'peak': 0}],
+                  'start': (time.perf_counter(), time.process_time())}
+    if worker_init_cpu is not None:
+        # Reported with the first page of the worker
+        page_stats['stages']['init'] = {'wall': 0.0, 'cpu': worker_init_cpu, 'peak': 0}
+        worker_init_cpu = None
+
+def finish_page_stats():
+    start_wall, start_cpu = page_stats.pop('start')
+    frame = page_stats.pop('frames')[0]
+    page_stats['wall'] = time.perf_counter() - start_wall
+    page_stats['cpu'] = time.process_time() - start_cpu
+    page_stats['peak'] = max(frame['peak'], read_peak_rss())
+    return page_stats
+
+def set_page_path(path, size):
+    # The way the page was converted, for the profile
+    if page_stats is not None:
+        page_stats['path'] = path
+        page_stats['pixels'] = size[0] * size[1]
+
+@contextlib.contextmanager
+def profile_stage(name):
+    # Time of nested stages is only counted for the innermost stage
+    if page_stats is None:
+        yield
+        return
+    frames = page_stats['frames']
+    frames[-1]['peak'] = max(frames[-1]['peak'], read_peak_rss())
+    reset_peak_rss()
+    frame = {'wall': 0.0, 'cpu': 0.0, 'peak': 0}
+    frames.append(frame)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        peak = max(frame['peak'], read_peak_rss())
+        frames.pop()
+        stats = page_stats['stages'].setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'peak': 0})
+        stats['wall'] += wall - frame['wall']
+        stats['cpu'] += cpu - frame['cpu']
+        stats['peak'] = max(stats['peak'], peak)
+        frames[-1]['wall'] += wall
+        frames[-1]['cpu'] += cpu
+        frames[-1]['peak'] = max(frames[-1]['peak'], peak)
+
+def skip_literal_string(stream, pos):
+    # pos is just after the opening parenthesis
+    depth = 1
+    while depth:
+        match = LITERAL_STRING_SPECIAL.search(stream, pos)
+        if not match:
+            return len(stream)
+        pos = match.end()
+        if match.group() == b'(':
+            depth += 1
+        elif match.group() == b')':
+            depth -= 1
+        else:
+            # Escaped character
+            pos += 1
+    return pos
+
+def tokenize_content(stream):
+    # Yields (start, end, token) for every token of a content stream.
+    # Strings are yielded as b'()', inline image data is skipped.
+    pos = 0
+    while pos < len(stream):
+        match = CONTENT_TOKEN.match(stream, pos)
+        if not match:
+            # Stray delimiter
+            pos += 1
+            continue
+        start = pos
+        pos = match.end()
+        token = match.group()
+        if token[0] in PDF_WHITESPACE or token[0] == ord('%'):
+            continue
+        if token == b'(':
+            pos = skip_literal_string(stream, pos)
+            token = b'()'
+        elif token == b'ID':
+            match = INLINE_IMAGE_END.search(stream, pos + 1)
+            pos = match.end() if match else len(stream)
+            token = b'EI'
+        yield start, pos, token
+
+def index_content_stream(stream):
+    """Read a content stream once and find, for the first Do of every
+    XObject name, the CTM and the clipping paths in effect, together with
+    the fill operators that come before it.
+    """
+    draws = {}
+    fills = []
+    operands = []
+    ctm = fitz.Matrix(1, 1)
+    clips = ()
+    stack = []
+    path = []
+    pending_clip = False
+    for start, end, token in tokenize_content(stream):
+        if token[0] in CONTENT_OPERAND_START:
+            operands.append(token)
+            continue
+        if token in PATH_OPERATORS:
+            path.append((token, tuple(float(it) for it in operands[len(operands) - PATH_OPERATORS[token]:])))
+        elif token in PAINT_OPERATORS:
+            if pending_clip:
+                clips += ((tuple(path), ctm),)
+                pending_clip = False
+            path = []
+            if token in (b'f', b'F', b'f*'):
+                fills.append((start, end))
+        elif token in (b'W', b'W*'):
+            pending_clip = True
+        elif token == b'q':
+            stack.append((ctm, clips))
+        elif token == b'Q':
+            if stack:
+                ctm, clips = stack.pop()
+        elif token == b'cm':
+            ctm = fitz.Matrix(*(float(it) for it in operands[-6:])) * ctm
+        elif token == b'Do' and operands and operands[-1][:1] == b'/':
+            name = operands[-1][1:].decode('latin-1')
+            if name not in draws:
+                draws[name] = ImageDraw(start, ctm, clips, len(stack))
+        operands = []
+    return draws, fills
+
+def index_page_contents(doc, page, images):
+    # Index the streams that draw the images of the page, each of them once.
+    # Images drawn by the page itself are looked up in all of its content
+    # streams, otherwise in the stream of the form XObject that draws them.
+    contents = {}
+    for image in images:
+        ref = image[9]
+        if ref in contents:
+            continue
+        xrefs = page.get_contents() if ref == 0 else [ref]
+        streams = [doc.xref_stream(xref) for xref in xrefs]
+        draws, fills = index_content_stream(b'\n'.join(streams))
+        contents[ref] = ContentIndex(xrefs, streams, draws, fills)
+    return contents
+
+def get_image_draw(contents, image):
+    return contents[image[9]].draws.get(image[7])
+
+def remove_path_fill(doc_noimg, images, contents):
+    # Fills drawn before the first image are usually its background, make
+    # them invisible in the overlay
     if len(images) == 0:
         return
     image = images[0]
-    image_name = image[7]
-    ref = get_referencer_of_image(image, page)
-    stream = doc.xref_stream(ref)
-    stream_split = stream.split(f'/{image_name} Do\n'.encode(), 1)
-    stream_split[0] = stream_split[0].replace(b'\nf\n', b'\nn\n').replace(b'\nf*\n', b'\nn\n')
-    doc.update_stream(ref, f'/{image_name} Do\n'.encode().join(stream_split))
+    content = contents[image[9]]
+    draw = content.draws.get(image[7])
+    if draw is None:
+        return
+    offset = 0
+    for xref, stream in zip(content.xrefs, content.streams):
+        fills = [(start - offset, end - offset) for start, end in content.fills
+                 if start < draw.offset and offset <= start < offset + len(stream)]
+        # Streams that are shared with a page that was already stripped
+        # are not touched again
+        if fills and doc_noimg.xref_stream(xref) == stream:
+            pieces = []
+            pos = 0
+            for start, end in fills:
+                pieces.append(stream[pos:start])
+                pieces.append(b'n')
+                pos = end
+            pieces.append(stream[pos:])
+            doc_noimg.update_stream(xref, b''.join(pieces))
+        # One separator between streams
+        offset += len(stream) + 1
+
+def load_page_noimg(doc_noimg, stripped, pagenum, images, contents):
+    # Strip only the page that is about to be converted, so the cost of
+    # building the overlay is paid once per page instead of once per worker.
+    # doc_noimg is kept open, a page that was stripped before (the same page
+    # again, or another part of a split page) is only loaded.
+    if pagenum in stripped:
+        return doc_noimg[pagenum]
+    page = doc_noimg[pagenum]
+    remove_path_fill(doc_noimg, images, contents)
+    for image in page.get_images():
+        xref = image[0]
+        page.delete_image(xref)
+    stripped.add(pagenum)
+    return doc_noimg.reload_page(page)
 
 def find_largest_image(images):
     size = 0
@@ -99,53 +432,102 @@ def find_largest_image(images):
             index = i
     return index
 
+def pixmap_to_image(pixmap, colorspace, alpha):
+    if colorspace == 'GRAY':
+        colorspace = 'L'
+    size = (pixmap.width, pixmap.height)
+    if alpha:
+        if colorspace == 'RGB':
+            # Unpremultiply while unpacking instead of converting a copy
+            return Image.frombytes('RGBA', size, pixmap.samples_mv, 'raw', 'RGBa')
+        # Pillow cannot unpack premultiplied LA
+        return Image.frombytes('La', size, pixmap.samples_mv).convert('LA')
+    if colorspace == 'L':
+        # Share the samples instead of copying them. Pillow stores RGB with
+        # 4 bytes per pixel, so RGB has to be copied.
+        image = Image.frombuffer('L', size, pixmap.samples_mv, 'raw', 'L', 0, 1)
+        # The samples belong to the pixmap
+        image.pixmap = pixmap
+        return image
+    return Image.frombytes(colorspace, size, pixmap.samples_mv)
+
+def pixmap_to_rgb_image(pixmap):
+    # The source pixmap is released by the caller as soon as it is converted
+    pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples_mv)
+
 def render_image(page, zoom, colorspace, alpha):
     if colorspace == 'L':
         colorspace = 'GRAY'
     pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=alpha)
-    if colorspace == 'GRAY':
-        colorspace = 'L'
-    if not alpha:
-        return Image.frombytes(colorspace, (pixmap.width, pixmap.height), pixmap.samples_mv)
-    image = Image.frombytes(colorspace + 'a', (pixmap.width, pixmap.height), pixmap.samples_mv)
-    image = image.convert(colorspace + 'A')
-    return image
+    return pixmap_to_image(pixmap, colorspace, alpha)
 
-def get_image_colorspace(doc, img_xref):
+def render_overlay(page_noimg, zoom, colorspace, clip):
+    # Render only the part of the stripped page that draws something.
+    # Returns the image and its position in the full page rendering.
+    if colorspace == 'L':
+        colorspace = 'GRAY'
+    pixmap = page_noimg.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=True, clip=clip)
+    return pixmap_to_image(pixmap, colorspace, alpha=True), (pixmap.x, pixmap.y)
+
+def read_image_info(doc, img_xref):
     cs_type, cs = doc.xref_get_key(img_xref, "ColorSpace")
-    if doc.xref_get_key(img_xref,"ImageMask")[1] == 'true':
+    bits = doc.xref_get_key(img_xref, "BitsPerComponent")[1]
+    return ImageInfo(img_xref,
+                     int(doc.xref_get_key(img_xref, "Width")[1]),
+                     int(doc.xref_get_key(img_xref, "Height")[1]),
+                     cs_type,
+                     cs,
+                     doc.xref_get_key(img_xref, "Filter")[1],
+                     doc.xref_get_key(img_xref, "ImageMask")[1] == 'true',
+                     int(bits) if bits.isdigit() else None,
+                     doc.xref_get_key(img_xref, "Decode")[0] != 'null')
+
+def get_image_info(doc, image_infos, img_xref):
+    # The image dictionary is only read the first time the image is used
+    # in this document. image_infos only holds ImageInfo tuples, so it can
+    # be pickled and sent to other processes.
+    info = image_infos.get(img_xref)
+    if info is None:
+        info = read_image_info(doc, img_xref)
+        image_infos[img_xref] = info
+    return info
+
+def get_image_colorspace(info):
+    if info.image_mask:
         return '1'
-    elif doc.xref_get_key(img_xref, "BitsPerComponent")[1] == '1':
+    elif info.bits == 1:
         return '1'
-    elif cs_type == 'xref':
+    elif info.cs_type == 'xref':
         return 'RGB'
-    elif cs == "/DeviceGray":
+    elif info.cs == "/DeviceGray":
         return 'L'
     else:
         return 'RGB'
 
-def extract_image(doc, img_xref, pagenum_str):
-    width = int(doc.xref_get_key(img_xref, "Width")[1])
-    height = int(doc.xref_get_key(img_xref, "Height")[1])
-    cs_type = doc.xref_get_key(img_xref, "ColorSpace")[0]
-    cs = doc.xref_get_key(img_xref, "ColorSpace")[1]
-    if doc.xref_get_key(img_xref, "Filter")[1] == '/DCTDecode':
+def is_plain_jpeg(info):
+    # The raw stream of the image can be used as a jpeg file
+    return info.filter == '/DCTDecode' and info.cs_type != 'xref' and info.cs != "/DeviceCMYK"
+
+def extract_image(doc, info, pagenum_str):
+    img_xref = info.xref
+    width = info.width
+    height = info.height
+    cs_type = info.cs_type
+    cs = info.cs
+    if info.filter == '/DCTDecode':
         if cs_type == 'xref':
             # Using xref_stream_raw directly produces image with inverted color
             # JOKER-我的同居小鬼(1) p3
-            pixmap = fitz.Pixmap(doc, img_xref)
-            pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
-            return "pil", Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples_mv)
+            return "pil", pixmap_to_rgb_image(fitz.Pixmap(doc, img_xref))
         if cs == "/DeviceCMYK":
             # Using xref_stream_raw directly produces image with inverted color
-            pixmap = fitz.Pixmap(doc, img_xref)
             # Use fitz.Pixmap to convert to RGB, so color is correct
-            pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
-            return "pil", Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples_mv)
+            return "pil", pixmap_to_rgb_image(fitz.Pixmap(doc, img_xref))
         return "jpeg", doc.xref_stream_raw(img_xref)
-    elif doc.xref_get_key(img_xref,"ImageMask")[1] == 'true':
+    elif info.image_mask:
         return "mask", Image.frombytes('1', (width, height), doc.xref_stream(img_xref))
-    elif doc.xref_get_key(img_xref, "BitsPerComponent")[1] == '1':
+    elif info.bits == 1:
         return "pil", Image.frombytes('1', (width, height), doc.xref_stream(img_xref))
     elif cs_type == 'xref':
         print(f"警告：{pagenum_str}-{img_xref} xref cs")
@@ -154,12 +536,11 @@ def extract_image(doc, img_xref, pagenum_str):
         img_data = img_dict["image"]
         return "pil", Image.open(BytesIO(img_data))
     elif cs == "/DeviceCMYK":
-        pixmap = fitz.Pixmap(doc, img_xref)
         # Use fitz.Pixmap to convert to RGB, so color is correct
-        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
-        return "pil", Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples_mv)
+        return "pil", pixmap_to_rgb_image(fitz.Pixmap(doc, img_xref))
     elif cs == "/DeviceGray":
-        return "pil", Image.frombytes('L', (width, height), doc.xref_stream(img_xref))
+        # Share the decoded stream instead of copying it
+        return "pil", Image.frombuffer('L', (width, height), doc.xref_stream(img_xref), 'raw', 'L', 0, 1)
     elif cs == "/DeviceRGB":
         return "pil", Image.frombytes('RGB', (width, height), doc.xref_stream(img_xref))
     else:
@@ -169,116 +550,234 @@ def extract_image(doc, img_xref, pagenum_str):
         img_data = img_dict["image"]
         return "pil", Image.open(BytesIO(img_data))
 
-def save_extracted_image(config, doc, page, image, output_dir):
+def save_extracted_image(config, doc, page, image, image_infos, output_dir):
     img_xref = image[0]
     pagenum_str = str(page.number + 1).zfill(3)
     output_name = f"{output_dir}/{pagenum_str}-{img_xref}"
-    image_type, image_extract = extract_image(doc, img_xref, pagenum_str)
+    with profile_stage('extract'):
+        image_type, image_extract = extract_image(doc, get_image_info(doc, image_infos, img_xref), pagenum_str)
     if image_type == 'jpeg':
-        with open(f"{output_name}.jpg",'wb') as f:
-            f.write(image_extract)
+        write_output(f"{output_name}.jpg", image_extract)
+        return f"{output_name}.jpg"
     else:
-        save_pil_image(config, image_extract, output_name)
-
-def create_clipping_path_image(doc, page, image, size, image_pos, image_size):
-    image_name = image[7]
-    image_xref = image[0]
-    width = int(doc.xref_get_key(image_xref, "Width")[1])
-    referencer = get_referencer_of_image(image, page)
-    stream = doc.xref_stream(referencer).split(f'\n/{image_name} Do\n'.encode())[0].split(b'\nQ\n')[-1]
-    if not b'\nW n\n' in stream:
-        # Clipping path is not set
-        return Image.new('1', image_size, 'white')
-    matrix = stream.split(b'\n')[-1].split(b' ')
-    if matrix[-1] != b'cm':
+        return save_pil_image(config, image_extract, output_name)
+
+def save_jpeg_images(doc, page, images, image_infos, output_dir):
+    # For 'extract-jpeg', also write the jpeg images of the page as they are
+    filenames = []
+    pagenum_str = str(page.number + 1).zfill(3)
+    for image in images:
+        img_xref = image[0]
+        if not is_plain_jpeg(get_image_info(doc, image_infos, img_xref)):
+            continue
+        filename = f"{output_dir}/{pagenum_str}-{img_xref}.jpg"
+        if filename in filenames:
+            continue
+        write_output(filename, doc.xref_stream_raw(img_xref))
+        filenames.append(filename)
+    return filenames
+
+def decode_jpeg(data):
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image
+
+def load_image(config, doc, info, pagenum_str):
+    # Decoded images are kept in a per-process LRU cache, so images that are
+    # shared by several pages are decoded only once
+    key = (doc.name, info.xref)
+    if key in decoded_images:
+        decoded_images.move_to_end(key)
+        return decoded_images[key]
+    with profile_stage('extract'):
+        image_type, image_extract = extract_image(doc, info, pagenum_str)
+        if image_type == 'jpeg':
+            image_extract = decode_jpeg(image_extract)
+    cache_image(config, key, image_type, image_extract)
+    return image_type, image_extract
+
+def load_images(config, doc, infos, pagenum_str):
+    # load_image() for every image of a page, returns {xref: (type, image)}.
+    # With 'decode-threads', jpeg images are decoded on threads, Pillow
+    # releases the GIL while decoding. MuPDF is not thread safe, so images
+    # are extracted on this thread.
+    if config['decode-threads'] <= 1:
+        return {info.xref: load_image(config, doc, info, pagenum_str) for info in infos}
+    loaded = {}
+    decoding = {}
+    with ThreadPoolExecutor(max_workers=config['decode-threads']) as executor:
+        for info in infos:
+            key = (doc.name, info.xref)
+            if info.xref in loaded or info.xref in decoding:
+                continue
+            if key in decoded_images:
+                decoded_images.move_to_end(key)
+                loaded[info.xref] = decoded_images[key]
+                continue
+            with profile_stage('extract'):
+                image_type, image_extract = extract_image(doc, info, pagenum_str)
+            if image_type == 'jpeg':
+                decoding[info.xref] = executor.submit(decode_jpeg, image_extract)
+            else:
+                cache_image(config, key, image_type, image_extract)
+                loaded[info.xref] = (image_type, image_extract)
+        with profile_stage('extract'):
+            for img_xref, future in decoding.items():
+                loaded[img_xref] = ('jpeg', future.result())
+                cache_image(config, (doc.name, img_xref), 'jpeg', loaded[img_xref][1])
+    return loaded
+
+def cache_image(config, key, image_type, image):
+    global decoded_images_size
+    size = get_image_memory(image)
+    if size <= config['image-cache'] * 2**20:
+        decoded_images[key] = (image_type, image)
+        decoded_images_size += size
+        while decoded_images_size > config['image-cache'] * 2**20:
+            _, (_, old_image) = decoded_images.popitem(last=False)
+            decoded_images_size -= get_image_memory(old_image)
+
+def get_image_memory(image):
+    # Pillow stores images with more than one band with 4 bytes per pixel
+    return image.width * image.height * (1 if len(image.getbands()) == 1 else 4)
+
+def get_clipping_paths(contents, image, info, height):
+    # Clipping paths of the image in pixels of the merged image, each as a
+    # list of (operator, coordinates), or None if clipping path is not set
+    draw = get_image_draw(contents, image)
+    if draw is None or not draw.clips:
+        return None
+    if draw.ctm.a <= 0:
         # Something wrong
-        return Image.new('1', image_size, 'white')
-    matrix_width = float(matrix[0])
-    zoom = width / matrix_width
-    commands = stream.split(b'\nW n')[0].split(b'\n')
-    surface = cairo.ImageSurface(cairo.FORMAT_A1, size[0], size[1])
+        return None
+    zoom = info.width / draw.ctm.a
+    clipping_paths = []
+    for path, ctm in draw.clips:
+        def to_pixel(x, y):
+            point = fitz.Point(x, y) * ctm
+            return point.x * zoom, height - point.y * zoom
+
+        ops = []
+        for op, numbers in path:
+            if op == b're':
+                x, y, w, h = numbers
+                if ctm.b == 0 and ctm.c == 0:
+                    ops.append((b're', to_pixel(x, y) + (w * ctm.a * zoom, h * ctm.d * zoom)))
+                else:
+                    # Rotated rectangle
+                    ops.append((b'm', to_pixel(x, y)))
+                    ops.append((b'l', to_pixel(x + w, y)))
+                    ops.append((b'l', to_pixel(x + w, y + h)))
+                    ops.append((b'l', to_pixel(x, y + h)))
+                    ops.append((b'h', ()))
+            else:
+                coords = ()
+                for i in range(0, len(numbers) - 1, 2):
+                    coords += to_pixel(numbers[i], numbers[i + 1])
+                ops.append((op, coords))
+        clipping_paths.append(ops)
+    return clipping_paths
+
+def clipping_path_covers(ops, image_pos, image_size):
+    # A single rectangle that contains the centers of all pixels of the image
+    # does not clip it
+    if len(ops) != 1 or ops[0][0] != b're':
+        return False
+    x, y, w, h = ops[0][1]
+    return (min(x, x + w) <= image_pos[0] + 0.25 and max(x, x + w) >= image_pos[0] + image_size[0] - 0.25
+            and min(y, y - h) <= image_pos[1] + 0.25 and max(y, y - h) >= image_pos[1] + image_size[1] - 0.25)
+
+def clipping_paths_cover(clipping_paths, image_pos, image_size):
+    return clipping_paths is None or all(clipping_path_covers(ops, image_pos, image_size) for ops in clipping_paths)
+
+def create_clipping_path_image(clipping_paths, image_pos, image_size):
+    # Returns None if the image is not clipped
+    if clipping_paths_cover(clipping_paths, image_pos, image_size):
+        return None
+    # Imported here, so processes that never clip do not load it
+    import cairo
+    # Only rasterize the area of the image, in the coordinates of the merged image
+    surface = cairo.ImageSurface(cairo.FORMAT_A1, image_size[0], image_size[1])
     ctx = cairo.Context(surface)
-    for command in commands:
-        op = command.split(b' ')
-        if op[-1] == b'm':
-            x = float(op[0]) * zoom
-            y = size[1] - float(op[1]) * zoom
-            ctx.move_to(x, y)
-        elif op[-1] == b'l':
-            x = float(op[0]) * zoom
-            y = size[1] - float(op[1]) * zoom
-            ctx.line_to(x, y)
-        elif op[-1] == b'c':
-            x1 = float(op[0]) * zoom
-            y1 = size[1] - float(op[1]) * zoom
-            x2 = float(op[2]) * zoom
-            y2 = size[1] - float(op[3]) * zoom
-            x3 = float(op[4]) * zoom
-            y3 = size[1] - float(op[5]) * zoom
-            ctx.curve_to(x1, y1, x2, y2, x3, y3)
-        elif op[-1] == b'v':
+    ctx.translate(-image_pos[0], -image_pos[1])
+    for ops in clipping_paths:
+        if not clipping_path_covers(ops, image_pos, image_size):
+            draw_clipping_path(ctx, ops)
+            # Nested clipping paths intersect
+            ctx.clip()
+    ctx.rectangle(image_pos[0], image_pos[1], image_size[0], image_size[1])
+    ctx.set_source_rgb(1,1,1)
+    ctx.fill()
+    return Image.frombuffer('1', image_size, surface.get_data(), 'raw', '1;R' ,surface.get_stride())
+
+def draw_clipping_path(ctx, ops):
+    for op, coords in ops:
+        if op == b'm':
+            ctx.move_to(*coords)
+        elif op == b'l':
+            ctx.line_to(*coords)
+        elif op == b'c':
+            ctx.curve_to(*coords)
+        elif op == b'v':
             x1, y1 = ctx.get_current_point()
-            x2 = float(op[0]) * zoom
-            y2 = size[1] - float(op[1]) * zoom
-            x3 = float(op[2]) * zoom
-            y3 = size[1] - float(op[3]) * zoom
-            ctx.curve_to(x1, y1, x2, y2, x3, y3)
-        elif op[-1] == b'y':
-            x1 = float(op[0]) * zoom
-            y1 = size[1] - float(op[1]) * zoom
-            x3 = float(op[2]) * zoom
-            y3 = size[1] - float(op[3]) * zoom
+            ctx.curve_to(x1, y1, *coords)
+        elif op == b'y':
+            x1, y1, x3, y3 = coords
             ctx.curve_to(x1, y1, x3, y3, x3, y3)
-        elif op[-1] == b're':
-            x = float(op[0]) * zoom
-            y = size[1] - float(op[1]) * zoom
-            w = float(op[2]) * zoom
-            h = float(op[3]) * zoom
+        elif op == b're':
+            x, y, w, h = coords
             ctx.move_to(x, y)
             ctx.line_to(x + w, y)
             ctx.line_to(x + w, y - h)
             ctx.line_to(x, y - h)
             ctx.close_path()
-        elif op[-1] == b'h':
+        elif op == b'h':
             ctx.close_path()
-    ctx.clip()
-    ctx.rectangle(0, 0, size[0], size[1])
-    ctx.set_source_rgb(1,1,1)
-    ctx.fill()
-    clipping_path = Image.frombuffer('1', size, surface.get_data(), 'raw', '1;R' ,surface.get_stride())
-    clipping_path = clipping_path.crop((image_pos[0], image_pos[1], image_pos[0] + image_size[0], image_pos[1] + image_size[1]))
-    return clipping_path
 
 def create_clipped_image_for_imagemask(imagemask, clipping_path):
+    if clipping_path is None:
+        return imagemask
     image_clipped = Image.new('1', imagemask.size, 255)
     image_clipped.paste(imagemask, mask=clipping_path)
     return image_clipped
 
-def generate_image(config, doc, page, page_noimg, images, output_dir):
+def get_image_placements(page):
+    # One pass over the page instead of one get_image_bbox() per image
+    placements = {}
+    for info in page.get_image_info(xrefs=True):
+        if info['xref'] not in placements:
+            placements[info['xref']] = (fitz.Rect(info['bbox']), fitz.Matrix(info['transform']))
+    # get_image_info() leaves every image of the page decoded in MuPDF's
+    # store, images are decoded by load_image() when they are needed
+    fitz.TOOLS.store_shrink(100)
+    return placements
+
+def layout_page(config, doc, page, images, image_infos):
     zoom_list = []
     image_matrix_list = []
     image_rect_list = []
-    has_warning = False
+    warnings = []
 
     is_mono = True
     mode_merge = 'L'
     pagenum_str = str(page.number + 1).zfill(3)
+    placements = get_image_placements(page)
     for image in images:
         img_xref = image[0]
-        img_name = image[7]
-        width = int(doc.xref_get_key(img_xref, "Width")[1])
-        height = int(doc.xref_get_key(img_xref, "Height")[1])
-        image_rect, image_matrix = page.get_image_bbox(img_name, transform=True)
+        info = get_image_info(doc, image_infos, img_xref)
+        width = info.width
+        height = info.height
+        if img_xref not in placements:
+            raise ValueError(f'{pagenum_str}-{img_xref}找不到圖片位置')
+        image_rect, image_matrix = placements[img_xref]
         if image_matrix[1:3] != (0, 0):
-            print(f'警告：{pagenum_str}-{img_xref}圖片旋轉或歪斜，輸出將與pdf不同')
-            has_warning = True
+            warnings.append(f'警告：{pagenum_str}-{img_xref}圖片旋轉或歪斜，輸出將與pdf不同')
         zoom = width / image_matrix[0]
         zoom_y = height / image_matrix[3]
         if zoom / zoom_y > 1.01 or zoom_y / zoom > 1.01:
-            print(f'警告：{pagenum_str}-{img_xref}圖片寬高比改變')
-            has_warning = True
+            warnings.append(f'警告：{pagenum_str}-{img_xref}圖片寬高比改變')
 
-        image_colorspace = get_image_colorspace(doc, img_xref)
+        image_colorspace = get_image_colorspace(info)
         if image_colorspace != '1':
             is_mono = False
         if image_colorspace == 'RGB':
@@ -291,14 +790,12 @@ def generate_image(config, doc, page, page_noimg, images, output_dir):
     zoom = zoom_list[find_largest_image(images)]
     for it in zoom_list:
         if math.ceil(page.rect[3] * zoom) != math.ceil(page.rect[3] * it):
-            print(f'警告：第{pagenum_str}頁包含多張圖片，縮放程度不同')
-            has_warning = True
+            warnings.append(f'警告：第{pagenum_str}頁包含多張圖片，縮放程度不同')
 
     rect_merge = page.rect
     if config['no-crop']:
         if len(images) > 1:
-            print(f"警告：第{pagenum_str}頁包含多張圖片，使用'no-crop'選項可能導致圖片重疊")
-            has_warning = True
+            warnings.append(f"警告：第{pagenum_str}頁包含多張圖片，使用'no-crop'選項可能導致圖片重疊")
         for image_rect in image_rect_list:
             if image_rect[0] < rect_merge[0]:
                 rect_merge[0] = image_rect[0]
@@ -309,26 +806,128 @@ def generate_image(config, doc, page, page_noimg, images, output_dir):
             if image_rect[3] > rect_merge[3]:
                 rect_merge[3] = image_rect[3]
 
-    if has_warning and config['render-image']:
-        print(f"第{pagenum_str}頁使用渲染方式產生圖片")
-        return render_image(page, zoom, colorspace=mode_merge, alpha=False)
-
     width_merge = math.ceil((rect_merge[2] - rect_merge[0]) * zoom)
     height_merge = math.ceil((rect_merge[3] - rect_merge[1]) * zoom)
-    img_merge = Image.new(mode_merge, (width_merge, height_merge), 'white')
-    for index in range(len(images)):
-        img_xref = images[index][0]
-        image_type, image_extract = extract_image(doc, img_xref, pagenum_str)
-        if image_type == 'jpeg':
-            if config['extract-jpeg']:
-                with open(f"{output_dir}/{pagenum_str}-{img_xref}.jpg",'wb') as f:
-                    f.write(image_extract)
-            image_extract = Image.open(BytesIO(image_extract))
-        image_pos = (round((image_matrix_list[index][4] - rect_merge[0]) * zoom), round((image_matrix_list[index][5] - rect_merge[1]) * zoom))
+    return PageLayout(zoom, image_matrix_list, image_rect_list, rect_merge,
+                      (width_merge, height_merge), mode_merge, is_mono, warnings)
+
+def get_overlay_rect(page_noimg):
+    # Area drawn by the stripped page, or None if it draws nothing.
+    # Deleted images are left as transparent images and are skipped, inline
+    # images are not deleted and still count.
+    rect = None
+    bboxes = [bbox for kind, bbox in page_noimg.get_bboxlog() if kind in OVERLAY_DRAWING_KINDS]
+    bboxes += [info['bbox'] for info in page_noimg.get_image_info(xrefs=True) if info['xref'] == 0]
+    for bbox in bboxes:
+        if rect is None:
+            rect = fitz.Rect(bbox)
+        else:
+            rect |= bbox
+    if rect is None:
+        return None
+    rect &= page_noimg.rect
+    if rect.is_empty:
+        return None
+    return rect
+
+def is_single_jpeg_page(doc, page, images, layout, image_infos):
+    # The page is one upright JPEG that fills the page
+    if len(images) != 1 or layout.warnings:
+        return False
+    info = get_image_info(doc, image_infos, images[0][0])
+    if info.filter != '/DCTDecode':
+        return False
+    if info.cs_type != 'name' or info.cs not in ('/DeviceGray', '/DeviceRGB'):
+        return False
+    if info.decode:
+        return False
+    image_matrix = layout.matrices[0]
+    if image_matrix[0] <= 0 or image_matrix[3] <= 0:
+        return False
+    # Compared in points, the size of the merged image is rounded up to whole
+    # pixels and can be one pixel larger than the JPEG
+    tolerance = 0.5 / layout.zoom
+    return all(abs(image - edge) <= tolerance for image, edge in zip(layout.rects[0], page.rect))
+
+def is_passthrough_page(config, doc, page, page_noimg, images, layout, image_infos, contents):
+    # Writing the JPEG as is gives the same result as generate_image()
+    if not is_single_jpeg_page(doc, page, images, layout, image_infos):
+        return False
+    if not config['no-crop']:
+        info = get_image_info(doc, image_infos, images[0][0])
+        clipping_paths = get_clipping_paths(contents, images[0], info, layout.size[1])
+        if not clipping_paths_cover(clipping_paths, (0, 0), layout.size):
+            return False
+    return page_noimg is None or get_overlay_rect(page_noimg) is None
+
+def get_image_positions(layout):
+    # Position of every image in the merged image
+    zoom = layout.zoom
+    rect_merge = layout.rect_merge
+    return [(round((matrix[4] - rect_merge[0]) * zoom), round((matrix[5] - rect_merge[1]) * zoom)) for matrix in layout.matrices]
+
+def get_page_placements(config, doc, images, layout, image_infos, contents):
+    # Image info of the images of the page with their position in the merged
+    # image and their clipping paths
+    placements = []
+    for image, image_pos in zip(images, get_image_positions(layout)):
+        info = get_image_info(doc, image_infos, image[0])
         if config['no-crop']:
-            clipping_path = Image.new('1', image_extract.size, 'white')
+            clipping_paths = None
         else:
-            clipping_path = create_clipping_path_image(doc, page, images[index], (width_merge, height_merge), image_pos, image_extract.size)
+            clipping_paths = get_clipping_paths(contents, image, info, layout.size[1])
+        placements.append((info, image_pos, clipping_paths))
+    return placements
+
+def load_page_sources(config, doc, page, placements):
+    # Decoded images of the placements, see compose_region()
+    pagenum_str = str(page.number + 1).zfill(3)
+    loaded = load_images(config, doc, [info for info, _, _ in placements], pagenum_str)
+    return [loaded[info.xref] + (image_pos, clipping_paths) for info, image_pos, clipping_paths in placements]
+
+def get_band_sources(config, doc, page, placements):
+    # Function that returns the sources of the images that overlap rows top
+    # to bottom. Bands are generated top to bottom, so an image is decoded
+    # for the first band it overlaps and dropped after the last one, and only
+    # the images of the band are in memory.
+    loaded = {}
+
+    def get_sources(top, bottom):
+        overlapping = [index for index, (info, (_, y), _) in enumerate(placements) if y < bottom and y + info.height > top]
+        for index in [it for it in loaded if it not in overlapping]:
+            del loaded[index]
+        missing = [index for index in overlapping if index not in loaded]
+        for index, source in zip(missing, load_page_sources(config, doc, page, [placements[index] for index in missing])):
+            loaded[index] = source
+        return [loaded[index] for index in overlapping]
+    return get_sources
+
+def get_overlay_clip(config, page_noimg):
+    # Part of the stripped page to render, or None if there is nothing to render
+    if config['original-only']:
+        return None
+    overlay_rect = get_overlay_rect(page_noimg)
+    if overlay_rect is None:
+        return None
+    # Leave room for anti-aliasing at the edges
+    return (overlay_rect + (-1, -1, 1, 1)) & page_noimg.rect
+
+@profile_stage('composite')
+def compose_region(config, page_noimg, layout, sources, overlay_clip, top, bottom):
+    # Rows top to bottom of the merged image
+    zoom = layout.zoom
+    rect_merge = layout.rect_merge
+    img_merge = Image.new(layout.mode, (layout.size[0], bottom - top), 'white')
+    for image_type, image_extract, (x, y), clipping_paths in sources:
+        crop_top = max(top - y, 0)
+        crop_bottom = min(bottom - y, image_extract.height)
+        if crop_top >= crop_bottom:
+            continue
+        if crop_top > 0 or crop_bottom < image_extract.height:
+            image_extract = image_extract.crop((0, crop_top, image_extract.width, crop_bottom))
+        with profile_stage('clip'):
+            clipping_path = create_clipping_path_image(clipping_paths, (x, y + crop_top), image_extract.size)
+        image_pos = (x, y + crop_top - top)
         if image_type == 'mask':
             clipped_image = create_clipped_image_for_imagemask(image_extract, clipping_path)
             del image_extract
@@ -341,73 +940,1714 @@ def generate_image(config, doc, page, page_noimg, images, output_dir):
             img_merge.paste(image_extract, image_pos, mask=clipping_path)
             del image_extract
             del clipping_path
-    if not config['original-only']:
-        img_noimg = render_image(page_noimg, zoom, colorspace=mode_merge, alpha=True)
-        img_merge.paste(img_noimg, (int(-rect_merge[0] * zoom), int(-rect_merge[1] * zoom)), img_noimg)
-        del img_noimg
+    if overlay_clip is not None:
+        offset = (int(-rect_merge[0] * zoom), int(-rect_merge[1] * zoom))
+        clip = fitz.Rect(overlay_clip.x0, (top - offset[1]) / zoom - 1, overlay_clip.x1, (bottom - offset[1]) / zoom + 1) & overlay_clip
+        if not clip.is_empty:
+            with profile_stage('render'):
+                img_noimg, overlay_pos = render_overlay(page_noimg, zoom, layout.mode, clip)
+            img_merge.paste(img_noimg, (offset[0] + overlay_pos[0], offset[1] + overlay_pos[1] - top), img_noimg)
+            del img_noimg
 
-    if is_mono and config['prefer-mono']:
-        img_merge = img_merge.point(lambda i: i>127 and 255, mode='1')
+    if layout.is_mono and config['prefer-mono']:
+        img_merge = img_merge.point(MONO_LUT, mode='1')
 
     return img_merge
 
+def generate_image(config, doc, page, page_noimg, images, layout, image_infos, contents):
+    pagenum_str = str(page.number + 1).zfill(3)
+    for warning in layout.warnings:
+        print(warning)
+    if layout.warnings and config['render-image']:
+        print(f"第{pagenum_str}頁使用渲染方式產生圖片")
+        set_page_path('render-fallback', layout.size)
+        with profile_stage('render'):
+            return render_image(page, layout.zoom, colorspace=layout.mode, alpha=False)
+    set_page_path('composite', layout.size)
+    sources = load_page_sources(config, doc, page, get_page_placements(config, doc, images, layout, image_infos, contents))
+    return compose_region(config, page_noimg, layout, sources, get_overlay_clip(config, page_noimg), 0, layout.size[1])
+
+def get_render_size(page, zoom):
+    rect = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return rect.width, rect.height
+
+@profile_stage('render')
+def render_region(page, zoom, mode, width, top, bottom):
+    # Rows top to bottom of render_image(), or of render_page_image() for '1'
+    render_mode = 'L' if mode == '1' else mode
+    clip = fitz.Rect(page.rect.x0, (top - 1) / zoom, page.rect.x1, (bottom + 1) / zoom) & page.rect
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace='GRAY' if render_mode == 'L' else render_mode, alpha=False, clip=clip)
+    band = Image.new(render_mode, (width, bottom - top), 'white')
+    band.paste(pixmap_to_image(pixmap, render_mode, alpha=False), (pixmap.x, pixmap.y - top))
+    if mode == '1':
+        band = band.point(MONO_LUT, mode='1')
+    return band
+
+def render_page_image(page, zoom, mode):
+    if mode == '1':
+        return render_image(page, zoom, colorspace='L', alpha=False).point(MONO_LUT, mode='1')
+    return render_image(page, zoom, colorspace=mode, alpha=False)
+
+def probe_page(config, page):
+    # Mode to render a page without images in, from a low resolution
+    # rendering. Returns the probe as well, it is all a blank page needs.
+    probe = render_image(page, PROBE_ZOOM, colorspace='RGB', alpha=False)
+    gray = probe.convert('L')
+    if gray.getextrema()[0] >= BLANK_THRESHOLD:
+        return 'blank', probe
+    channels = probe.split()
+    lightest = ImageChops.lighter(ImageChops.lighter(channels[0], channels[1]), channels[2])
+    darkest = ImageChops.darker(ImageChops.darker(channels[0], channels[1]), channels[2])
+    if ImageChops.subtract(lightest, darkest).getextrema()[1] > COLOR_THRESHOLD:
+        return 'RGB', probe
+    if not config['prefer-mono']:
+        return 'L', probe
+    # Edges of text and lines are gray at this resolution too, but they are
+    # next to paper or ink. Gray with little contrast around it is a tint or
+    # a gradient, which 1-bit would lose.
+    contrast = ImageChops.subtract(gray.filter(ImageFilter.MaxFilter(3)), gray.filter(ImageFilter.MinFilter(3)))
+    flat = contrast.point(lambda value: 255 if value < 32 else 0)
+    midtone = gray.point(lambda value: 255 if 64 <= value < 192 else 0)
+    flat_gray = ImageChops.multiply(flat, midtone).histogram()[255]
+    if flat_gray > gray.width * gray.height * MONO_MAX_GRAY:
+        return 'L', probe
+    return '1', probe
+
+def is_banded_page(config, size):
+    # Pages that are saved as png and taller than 'band-height' are
+    # generated and written one band at a time
+    if not config['band-height'] or size[1] <= config['band-height']:
+        return False
+    return config['save-png'] or (not config['save-jxl'] and max(size) > WEBP_MAX_SIZE)
+
+def get_banded_source(config, doc, page, page_noimg, images, layout, image_infos, contents):
+    # Mode and size of a page with images that is written in bands, and the
+    # function that generates the bands
+    pagenum_str = str(page.number + 1).zfill(3)
+    for warning in layout.warnings:
+        print(warning)
+    if layout.warnings and config['render-image']:
+        print(f"第{pagenum_str}頁使用渲染方式產生圖片")
+        size = get_render_size(page, layout.zoom)
+        set_page_path('render-fallback-banded', size)
+        return layout.mode, size, lambda top, bottom: render_region(page, layout.zoom, layout.mode, size[0], top, bottom)
+    set_page_path('composite-banded', layout.size)
+    get_sources = get_band_sources(config, doc, page, get_page_placements(config, doc, images, layout, image_infos, contents))
+    overlay_clip = get_overlay_clip(config, page_noimg)
+    mode = '1' if layout.is_mono and config['prefer-mono'] else layout.mode
+    return mode, layout.size, lambda top, bottom: compose_region(config, page_noimg, layout, get_sources(top, bottom), overlay_clip, top, bottom)
+
+def save_banded_image(config, doc, page, page_noimg, images, layout, image_infos, contents, output_name):
+    mode, size, generate_band = get_banded_source(config, doc, page, page_noimg, images, layout, image_infos, contents)
+    return write_png_bands(config, mode, size, generate_band, output_name)
+
+def get_page_parts(config, plan):
+    # Number of workers that convert parts of a page with 'split-pages'.
+    # Pages taller than 'band-height' are split. The compressed rows of
+    # pages written in bands are joined into the png file, the rows of other
+    # pages are joined and encoded once.
+    if not config['split-pages'] or plan.kind not in ('render', 'render-fallback', 'composite') or plan.size is None:
+        return 1
+    if not config['band-height'] or plan.size[1] <= config['band-height']:
+        return 1
+    return min(config['processes'], math.ceil(plan.size[1] / config['band-height']))
+
+def get_part_rows(config, height, part):
+    # Rows of a part, whole bands so that the bands are the same as when the
+    # page is not split
+    index, count = part
+    bands = math.ceil(height / config['band-height'])
+    return (bands * index // count * config['band-height'],
+            min(bands * (index + 1) // count * config['band-height'], height))
+
+def write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+@profile_stage('encode')
+def write_png_bands(config, mode, size, generate_band, output_name):
+    # Stream the image into a png file band by band. generate_band(top, bottom)
+    # returns the rows top to bottom of the image.
+    if not config['save-png']:
+        print('尺寸過大，改存為png')
+    filename = f"{output_name}.png"
+    width, height = size
+    bit_depth, color_type = PNG_FORMATS[mode]
+    compressor = zlib.compressobj(config['png-compress-level'])
+    previous_row = None
+    with open_output(filename) if page_outputs is None else BytesIO() as f:
+        f.write(PNG_SIGNATURE)
+        write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+        for top in range(0, height, config['band-height']):
+            data, previous_row = filter_png_band(mode, generate_band(top, min(top + config['band-height'], height)), previous_row)
+            compressed = compressor.compress(data)
+            del data
+            if compressed:
+                write_png_chunk(f, b'IDAT', compressed)
+        write_png_chunk(f, b'IDAT', compressor.flush())
+        write_png_chunk(f, b'IEND', b'')
+        if page_outputs is not None:
+            page_outputs[filename] = f.getvalue()
+    return filename
+
+def filter_png_band(mode, band, previous_row):
+    # Rows of the band, each preceded by its png filter type, and the last
+    # row of the band, which the next band is filtered against
+    if mode == '1':
+        filter_type = b'\0'
+        data = band.tobytes()
+    else:
+        # 'Up' filter, the difference to the row above
+        rows_above = Image.new(mode, band.size)
+        rows_above.paste(band, (0, 1))
+        if previous_row is not None:
+            rows_above.paste(previous_row, (0, 0))
+        filter_type = b'\2'
+        data = ImageChops.subtract_modulo(band, rows_above).tobytes()
+        del rows_above
+    last_row = band.crop((0, band.height - 1, band.width, band.height))
+    stride = len(data) // band.height
+    del band
+    data = memoryview(data)
+    return b''.join(filter_type + data[i:i + stride] for i in range(0, len(data), stride)), last_row
+
+@profile_stage('encode')
+def compress_png_rows(config, mode, size, generate_band, top, bottom):
+    # Rows top to bottom of a png image as raw deflate data, which
+    # join_png_rows() puts together with the rows of the other parts
+    compressor = zlib.compressobj(config['png-compress-level'], zlib.DEFLATED, -15)
+    previous_row = None
+    if top > 0 and mode != '1':
+        # The first row is filtered against the last row of the part above
+        previous_row = generate_band(top - 1, top)
+    checksum = zlib.adler32(b'')
+    length = 0
+    compressed = []
+    for band_top in range(top, bottom, config['band-height']):
+        data, previous_row = filter_png_band(mode, generate_band(band_top, min(band_top + config['band-height'], bottom)), previous_row)
+        checksum = zlib.adler32(data, checksum)
+        length += len(data)
+        compressed.append(compressor.compress(data))
+        del data
+    # Ends on a byte boundary without a final block, so that the rows of the
+    # next part can follow
+    compressed.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+    return {'mode': mode, 'size': size, 'data': b''.join(compressed), 'adler32': checksum, 'length': length}
+
+def generate_part_rows(config, mode, size, generate_band, top, bottom):
+    # Rows top to bottom of an image that is not written in bands, which the
+    # parent joins with the rows of the other parts
+    data = b''.join(generate_band(band_top, min(band_top + config['band-height'], bottom)).tobytes()
+                    for band_top in range(top, bottom, config['band-height']))
+    return {'mode': mode, 'size': size, 'data': data}
+
+def combine_adler32(checksum1, checksum2, length2):
+    # Checksum of two pieces of data from their checksums, adler32_combine()
+    # of zlib
+    base = 65521
+    remainder = length2 % base
+    sum1 = ((checksum1 & 0xffff) + (checksum2 & 0xffff) + base - 1) % base
+    sum2 = (remainder * (checksum1 & 0xffff) + (checksum1 >> 16) + (checksum2 >> 16) + base - remainder) % base
+    return sum1 | (sum2 << 16)
+
+def join_png_rows(config, parts):
+    # png file from the rows of every part, see compress_png_rows()
+    width, height = parts[0]['size']
+    bit_depth, color_type = PNG_FORMATS[parts[0]['mode']]
+    checksum = zlib.adler32(b'')
+    with BytesIO() as f:
+        f.write(PNG_SIGNATURE)
+        write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+        # zlib header
+        write_png_chunk(f, b'IDAT', zlib.compress(b'', config['png-compress-level'])[:2])
+        for part in parts:
+            if part['data']:
+                write_png_chunk(f, b'IDAT', part['data'])
+            checksum = combine_adler32(checksum, part['adler32'], part['length'])
+        # Empty final block and the checksum of all rows
+        write_png_chunk(f, b'IDAT', zlib.compressobj(config['png-compress-level'], zlib.DEFLATED, -15).flush() + struct.pack('>I', checksum))
+        write_png_chunk(f, b'IEND', b'')
+        return f.getvalue()
+
+@contextlib.contextmanager
+def open_output(filename):
+    # Written under a temporary name and moved into place. With 'dedupe' the
+    # file may be a link to the file of another page, which must be replaced
+    # instead of overwritten.
+    temp_filename = f'{filename}.tmp'
+    try:
+        with open(temp_filename, 'wb') as f:
+            yield f
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+def write_output(filename, data):
+    # In archive mode the files of the page are returned to the parent,
+    # which writes them into the archive
+    if page_outputs is None:
+        with open_output(filename) as f:
+            f.write(data)
+    else:
+        page_outputs[filename] = data
+
+def save_output_image(image, filename, **params):
+    if page_outputs is None:
+        with open_output(filename) as f:
+            image.save(f, format=Image.registered_extensions()[os.path.splitext(filename)[1]], **params)
+    else:
+        buffer = BytesIO()
+        image.save(buffer, format=Image.registered_extensions()[os.path.splitext(filename)[1]], **params)
+        page_outputs[filename] = buffer.getvalue()
+
+@profile_stage('encode')
 def save_pil_image(config, image, output_name):
     if config['save-png']:
-        image.save(f"{output_name}.png")
+        filename = f"{output_name}.png"
+        save_output_image(image, filename, compress_level=config['png-compress-level'])
     elif config['save-jxl']:
+        # Registers the JPEG XL plugin of Pillow
+        import pillow_jxl
         if image.mode == '1':
             image = image.convert('L')
-        image.save(f"{output_name}.jxl", lossless=True)
+        filename = f"{output_name}.jxl"
+        save_output_image(image, filename, lossless=True, effort=config['jxl-effort'])
     else:
-        if max(image.size) > 16383:
+        if max(image.size) > WEBP_MAX_SIZE:
             print('尺寸過大，改存為png')
-            image.save(f"{output_name}.png")
+            filename = f"{output_name}.png"
+            save_output_image(image, filename, compress_level=config['png-compress-level'])
         else:
-            image.save(f"{output_name}.webp", lossless=True)
+            filename = f"{output_name}.webp"
+            save_output_image(image, filename, lossless=True, quality=config['webp-quality'], method=config['webp-method'])
+    return filename
 
-def convert_page(config, pagenum, output_dir, event):
+def encode_image(config, mode, size, data, output_name):
+    # Runs in the encoder processes. Returns the result of the encoded file
+    # like page_result().
+    global page_outputs
+    page_outputs = {} if config['archive'] else None
+    start_page_stats(config)
     try:
-        if event.is_set():
-            return 1
-        global doc
-        if not doc:
-            # Failed in convert_page_init()
-            return 0
+        image = Image.frombuffer(mode, size, data, 'raw', mode, 0, 1)
+        return page_result([save_pil_image(config, image, output_name)], {})
+    except Exception:
+        print(traceback.format_exc())
+        return None
+
+def open_document(file, source):
+    # Keep the most recently used documents open, so a worker that is given
+    # pages of several files does not reopen them for every page. source is
+    # the checksum of the file, a file that changed is opened again.
+    key = (file, source)
+    if key in documents:
+        documents.move_to_end(key)
+        return documents[key]
+    for old_key in [it for it in documents if it[0] == file]:
+        close_document(old_key)
+    doc = fitz.open(file)
+    # Pages are stripped lazily by load_page_noimg(), which records them in
+    # the set of stripped pages
+    doc_noimg = fitz.open(file)
+    documents[key] = (doc, doc_noimg, {}, set())
+    while len(documents) > DOCUMENT_CACHE_SIZE:
+        close_document(next(iter(documents)))
+    return documents[key]
+
+def close_document(key):
+    # Decoded images are cached by file and xref, they are dropped with the
+    # document, so a changed file does not reuse the images of the old one
+    global decoded_images_size
+    doc, doc_noimg, _, _ = documents.pop(key)
+    doc.close()
+    doc_noimg.close()
+    for image_key in [it for it in decoded_images if it[0] == key[0]]:
+        _, image = decoded_images.pop(image_key)
+        decoded_images_size -= get_image_memory(image)
+
+def load_page(config, doc, doc_noimg, stripped, page, images, image_infos):
+    # Content index, stripped page and layout of a page with images
+    with profile_stage('index'):
+        contents = index_page_contents(doc, page, images)
+    if config['original-only']:
+        page_noimg = None
+    else:
+        with profile_stage('strip'):
+            page_noimg = load_page_noimg(doc_noimg, stripped, page.number, images, contents)
+    with profile_stage('layout'):
+        layout = layout_page(config, doc, page, images, image_infos)
+    return contents, page_noimg, layout
+
+def convert_page(config, file, source, pagenum, output_dir, references, render_zoom):
+    """Convert one page. Returns None if the page failed or the conversion
+    was stopped, otherwise a dict with the names of the written files and,
+    for 'only-extract', the images that were left to an earlier page.
+    With 'encode-processes', the page image is returned unencoded in 'image'.
+    With 'archive', the contents of the files are returned in 'data'.
+    """
+    global page_outputs
+    page_outputs = {} if config['archive'] else None
+    start_page_stats(config)
+    try:
+        if stop_event.is_set():
+            return None
+        with profile_stage('open'):
+            doc, doc_noimg, image_infos, stripped = open_document(file, source)
         page = doc[pagenum]
         images = page.get_images(full=True)
+        pagenum_str = str(pagenum + 1).zfill(3)
+        filenames = []
         if config['only-extract']:
+            set_page_path('extract', (sum(image[2] * image[3] for image in images), 1))
             for image in images:
-                save_extracted_image(config, doc, page, image, output_dir)
-            return 1
+                if image[0] in references:
+                    # Already written for another page
+                    continue
+                filename = save_extracted_image(config, doc, page, image, image_infos, output_dir)
+                if filename not in filenames:
+                    filenames.append(filename)
+            return page_result(filenames, references)
         if not images:
-            image = render_image(page, 600 / 72, colorspace='GRAY', alpha=False)
+            mode = 'L'
+            if config['adaptive-render']:
+                with profile_stage('probe'):
+                    mode, probe = probe_page(config, page)
+                if mode == 'blank':
+                    set_page_path('blank', probe.size)
+                    image = Image.new('1', probe.size, 1)
+            if mode != 'blank':
+                size = get_render_size(page, render_zoom)
+                if is_banded_page(config, size):
+                    set_page_path('render-banded', size)
+                    filenames.append(write_png_bands(config, mode, size,
+                                                     lambda top, bottom: render_region(page, render_zoom, mode, size[0], top, bottom),
+                                                     f"{output_dir}/{pagenum_str}"))
+                    return page_result(filenames, references)
+                set_page_path('render', size)
+                with profile_stage('render'):
+                    image = render_page_image(page, render_zoom, mode)
         else:
-            global doc_noimg
-            page_noimg = doc_noimg[pagenum]
-            image = generate_image(config, doc, page, page_noimg, images, output_dir)
-        save_pil_image(config, image, f"{output_dir}/{str(pagenum + 1).zfill(3)}")
-        return 1
+            contents, page_noimg, layout = load_page(config, doc, doc_noimg, stripped, page, images, image_infos)
+            if config['extract-jpeg'] and not (layout.warnings and config['render-image']):
+                filenames += save_jpeg_images(doc, page, images, image_infos, output_dir)
+            if config['passthrough-jpeg'] and is_passthrough_page(config, doc, page, page_noimg, images, layout, image_infos, contents):
+                set_page_path('passthrough', layout.size)
+                filename = f"{output_dir}/{pagenum_str}.jpg"
+                write_output(filename, doc.xref_stream_raw(images[0][0]))
+                filenames.append(filename)
+                return page_result(filenames, references)
+            if is_banded_page(config, layout.size):
+                # Written here even with 'encode-processes', the whole page
+                # is never in memory
+                filenames.append(save_banded_image(config, doc, page, page_noimg, images, layout, image_infos, contents, f"{output_dir}/{pagenum_str}"))
+                return page_result(filenames, references)
+            image = generate_image(config, doc, page, page_noimg, images, layout, image_infos, contents)
+        if config['encode-processes']:
+            # Leave encoding to the encoder processes, so this process can
+            # start on the next page
+            with profile_stage('transfer'):
+                data = image.tobytes()
+            result = page_result(filenames, references)
+            result['image'] = (image.mode, image.size, data, f"{output_dir}/{pagenum_str}")
+            return result
+        filenames.append(save_pil_image(config, image, f"{output_dir}/{pagenum_str}"))
+        return page_result(filenames, references)
     except Exception:
         print(traceback.format_exc())
-        return 0
+        return None
 
-def convert_page_init(file):
+def convert_page_part(config, file, source, pagenum, output_dir, render_zoom, part):
+    """Convert the rows of one part of a page, with 'split-pages'. Returns
+    None if the part failed or the conversion was stopped, otherwise a dict
+    like convert_page() with the compressed rows in 'rows' for pages that are
+    written in bands, or the raw rows in 'pixels'. The first part also writes
+    the other files of the page.
+    """
+    global page_outputs
+    page_outputs = {} if config['archive'] else None
+    start_page_stats(config)
     try:
-        global doc
-        global doc_noimg
-        doc = fitz.open(file)
-        doc_noimg = fitz.open(file)
-        for page in doc_noimg:
-            remove_path_fill(doc_noimg, page)
-            for image in page.get_images():
-                xref = image[0]
-                page.delete_image(xref)
-        doc_noimg = fitz.open('pdf', doc_noimg.tobytes(garbage=1))
+        if stop_event.is_set():
+            return None
+        with profile_stage('open'):
+            doc, doc_noimg, image_infos, stripped = open_document(file, source)
+        page = doc[pagenum]
+        images = page.get_images(full=True)
+        pagenum_str = str(pagenum + 1).zfill(3)
+        filenames = []
+        if not images:
+            mode = 'L'
+            if config['adaptive-render']:
+                with profile_stage('probe'):
+                    mode, probe = probe_page(config, page)
+                if mode == 'blank':
+                    set_page_path('blank', probe.size)
+                    if part[0] == 0:
+                        filenames.append(save_pil_image(config, Image.new('1', probe.size, 1), f"{output_dir}/{pagenum_str}"))
+                    return page_result(filenames, {})
+            size = get_render_size(page, render_zoom)
+            set_page_path('render-banded', size)
+            generate_band = lambda top, bottom: render_region(page, render_zoom, mode, size[0], top, bottom)
+        else:
+            contents, page_noimg, layout = load_page(config, doc, doc_noimg, stripped, page, images, image_infos)
+            if part[0] == 0 and config['extract-jpeg'] and not (layout.warnings and config['render-image']):
+                filenames += save_jpeg_images(doc, page, images, image_infos, output_dir)
+            mode, size, generate_band = get_banded_source(config, doc, page, page_noimg, images, layout, image_infos, contents)
+        # Before page_result(), which ends the stats of the page
+        if not is_banded_page(config, size):
+            key = 'pixels'
+            rows = generate_part_rows(config, mode, size, generate_band, *get_part_rows(config, size[1], part))
+        else:
+            if part[0] == 0 and not config['save-png']:
+                print('尺寸過大，改存為png')
+            key = 'rows'
+            rows = compress_png_rows(config, mode, size, generate_band, *get_part_rows(config, size[1], part))
+        result = page_result(filenames, {})
+        result[key] = rows
+        return result
     except Exception:
         print(traceback.format_exc())
-        del doc
+        return None
+
+def join_page_parts(config, output_dir, pagenum, parts):
+    # Result of a page from the results of convert_page_part(). Raw rows are
+    # returned in 'image' like with 'encode-processes', for the encoder.
+    result = {'files': [], 'references': {}}
+    if config['archive']:
+        result['data'] = {}
+    for part in parts:
+        result['files'] += part['files']
+        if 'data' in part:
+            result['data'].update(part['data'])
+    if 'pixels' in parts[0]:
+        pixels = parts[0]['pixels']
+        data = b''.join(part.pop('pixels')['data'] for part in parts)
+        result['image'] = (pixels['mode'], pixels['size'], data, f"{output_dir}/{str(pagenum + 1).zfill(3)}")
+    elif 'rows' in parts[0]:
+        name = f"{str(pagenum + 1).zfill(3)}.png"
+        data = join_png_rows(config, [part['rows'] for part in parts])
+        if config['archive']:
+            result['data'][name] = data
+        else:
+            with open_output(f"{output_dir}/{name}") as f:
+                f.write(data)
+        result['files'].append({'name': name, 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+    if config['profile']:
+        result['stats'] = parts[0]['stats']
+        for part in parts[1:]:
+            merge_part_stats(result['stats'], part['stats'])
+    return result
+
+def copy_page_result(result, pagenum, output_dir, duplicate_pagenum, duplicate_dir):
+    # Result of a page that looks the same as a converted page, for 'dedupe'.
+    # The files are linked, or copied where links are not supported, under
+    # the names of the duplicate page.
+    prefix = str(pagenum + 1).zfill(3)
+    duplicate_prefix = str(duplicate_pagenum + 1).zfill(3)
+    copy = {'files': [], 'references': {}}
+    if 'data' in result:
+        copy['data'] = {}
+    for file in result['files']:
+        name = duplicate_prefix + file['name'][len(prefix):]
+        if 'data' in result:
+            copy['data'][name] = result['data'][file['name']]
+        else:
+            link_file(os.path.join(output_dir, file['name']), os.path.join(duplicate_dir, name))
+        copy['files'].append(dict(file, name=name))
+    return copy
+
+def link_file(source, target):
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def file_checksum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def describe_output(filename):
+    # Recorded in the manifest to check the file on the next run
+    if page_outputs is not None:
+        return {'name': os.path.basename(filename),
+                'size': len(page_outputs[filename]),
+                'sha256': hashlib.sha256(page_outputs[filename]).hexdigest()}
+    return {'name': os.path.basename(filename),
+            'size': os.path.getsize(filename),
+            'sha256': file_checksum(filename)}
+
+def page_result(filenames, references):
+    result = {'files': [describe_output(filename) for filename in filenames],
+              'references': references}
+    if page_outputs is not None:
+        result['data'] = {os.path.basename(filename): page_outputs[filename] for filename in filenames}
+    if page_stats is not None:
+        result['stats'] = finish_page_stats()
+    return result
+
+def convert_pages(config, file, source, pagenums, output_dir, references, render_zoom):
+    return [convert_page(config, file, source, pagenum, output_dir, references.get(pagenum, {}), render_zoom) for pagenum in pagenums]
+
+def convert_page_init(event):
+    global stop_event
+    global documents
+    global decoded_images
+    global decoded_images_size
+    global worker_init_cpu
+    # The parent sets the event to stop the conversion
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop_event = event
+    documents = OrderedDict()
+    decoded_images = OrderedDict()
+    decoded_images_size = 0
+    # CPU time of starting the worker, mostly importing modules. A forked
+    # worker did not import them and its CPU time starts with the fork, so
+    # there is nothing to report.
+    if import_pid == os.getpid():
+        worker_init_cpu = time.process_time()
+
+def encode_image_init():
+    # Pages being encoded are finished even when the conversion is stopped
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def find_image_references(doc, pagenums):
+    # For 'only-extract', every image is written by the first of pagenums
+    # that uses it, pages that are not converted in this run (or by this
+    # shard) do not write it. Returns {pagenum: {xref: pagenum of that page}}.
+    owners = {}
+    references = {}
+    for pagenum in sorted(pagenums):
+        for image in doc[pagenum].get_images(full=True):
+            img_xref = image[0]
+            owner = owners.setdefault(img_xref, pagenum)
+            if owner != pagenum:
+                references.setdefault(pagenum, {})[img_xref] = owner
+    return references
+
+def plan_page(config, doc, page, image_infos, render_zoom):
+    pagenum = page.number
+    images = page.get_images(full=True)
+    if config['only-extract']:
+        pixels = sum(image[2] * image[3] for image in images)
+        return PagePlan(pagenum, 'extract', pixels, None, None, None,
+                        estimate_page_memory(config, doc, 'extract', pixels, None, images, image_infos))
+    if not images:
+        size = get_render_size(page, render_zoom)
+        # Only the worker knows the mode 'adaptive-render' picks
+        mode = 'RGB' if config['adaptive-render'] else 'L'
+        return PagePlan(pagenum, 'render', size[0] * size[1], size, mode, render_zoom,
+                        estimate_page_memory(config, doc, 'render', get_canvas_pixels(config, size), mode, images, image_infos))
+    try:
+        layout = layout_page(config, doc, page, images, image_infos)
+    except Exception:
+        # Let the worker report the error, estimate from the images only
+        pixels = sum(image[2] * image[3] for image in images)
+        return PagePlan(pagenum, 'composite', pixels, None, 'RGB', None,
+                        estimate_page_memory(config, doc, 'composite', pixels, 'RGB', images, image_infos))
+    if layout.warnings and config['render-image']:
+        kind = 'render-fallback'
+    elif config['passthrough-jpeg'] and is_single_jpeg_page(doc, page, images, layout, image_infos):
+        kind = 'passthrough'
+    else:
+        kind = 'composite'
+    pixels = layout.size[0] * layout.size[1]
+    return PagePlan(pagenum, kind, pixels, layout.size, layout.mode, layout.zoom,
+                    estimate_page_memory(config, doc, kind, get_canvas_pixels(config, layout.size), layout.mode, images, image_infos, layout))
+
+def plan_document(config, doc, pagenums=None, render_zoom=None):
+    image_infos = {}
+    if pagenums is None:
+        pagenums = range(doc.page_count)
+    if render_zoom is None:
+        render_zoom = get_render_zoom(config, doc)
+    return [plan_page(config, doc, doc[pagenum], image_infos, render_zoom) for pagenum in pagenums]
+
+def get_render_zoom(config, doc):
+    # Zoom of the pages without images. With 'adaptive-render', the
+    # resolution most image pages are scanned at, so the rendered pages match
+    # them. Looks at the whole document, not only the selected pages, so that
+    # every shard agrees.
+    zoom = config['render-dpi'] / 72
+    if not config['adaptive-render']:
+        return zoom
+    counts = {}
+    step = max(doc.page_count // RENDER_ZOOM_SAMPLES, 1)
+    for pagenum in range(0, doc.page_count, step):
+        page = doc[pagenum]
+        images = page.get_images(full=True)
+        if not images:
+            continue
+        image = images[find_largest_image(images)]
+        placement = get_image_placements(page).get(image[0])
+        if placement is None or placement[1][0] <= 0:
+            # Not placed, rotated or flipped
+            continue
+        # Rounded to 10 dpi, scans of the same resolution differ slightly
+        dpi = round(image[2] / placement[1][0] * 72 / 10) * 10
+        if dpi > 0:
+            counts[dpi] = counts.get(dpi, 0) + 1
+    if counts:
+        zoom = max(counts, key=lambda dpi: (counts[dpi], dpi)) / 72
+    return zoom
+
+def get_page_keys(config, doc, pagenums, render_zoom):
+    # For 'dedupe', {pagenum: key} of pages that look the same, or None
+    # where the key cannot be computed
+    hashes = {}
+    keys = {}
+    for pagenum in pagenums:
+        try:
+            keys[pagenum] = hash_page_inputs(doc, doc[pagenum], render_zoom, hashes)
+        except Exception:
+            # Malformed or too deeply nested objects, the page is converted
+            keys[pagenum] = None
+    return keys
+
+def hash_page_inputs(doc, page, render_zoom, hashes):
+    # Hash of what a page is made of instead of its pixels: its boxes,
+    # rotation, content streams, resources and annotations, with every
+    # referenced object replaced by the hash of that object. The same page in
+    # another file has the same hash.
+    sha256 = hashlib.sha256()
+    sha256.update(repr((tuple(page.rect), tuple(page.cropbox), tuple(page.mediabox), page.rotation, render_zoom)).encode())
+    for key in PAGE_CONTENT_KEYS:
+        sha256.update(key.encode())
+        sha256.update(hash_pdf_source(doc, get_inherited_key(doc, page.xref, key)[1].encode(), hashes))
+    return sha256.hexdigest()
+
+def get_inherited_key(doc, xref, key):
+    # Resources can be set on a parent of the page
+    while True:
+        value_type, value = doc.xref_get_key(xref, key)
+        if value_type != 'null':
+            return value_type, value
+        parent_type, parent = doc.xref_get_key(xref, 'Parent')
+        if parent_type != 'xref':
+            return value_type, value
+        xref = int(parent.split()[0])
+
+def hash_pdf_source(doc, source, hashes):
+    sha256 = hashlib.sha256()
+    pos = 0
+    for match in PDF_REFERENCE.finditer(source):
+        xref = int(match[1])
+        if 0 < xref < doc.xref_length():
+            sha256.update(source[pos:match.start()])
+            sha256.update(hash_pdf_object(doc, xref, hashes))
+            pos = match.end()
+    sha256.update(source[pos:])
+    return sha256.digest()
+
+def hash_pdf_object(doc, xref, hashes):
+    if xref in hashes:
+        return hashes[xref]
+    # Objects that refer back to themselves
+    hashes[xref] = b''
+    if doc.xref_get_key(xref, 'Type')[1] in ('/Page', '/Pages'):
+        # Links and parents of annotations, which lead to other pages and do
+        # not change how this page looks
+        hashes[xref] = b'page'
+        return hashes[xref]
+    digest = hash_pdf_source(doc, doc.xref_object(xref, compressed=True).encode(), hashes)
+    if doc.xref_is_stream(xref):
+        digest = hashlib.sha256(digest + doc.xref_stream_raw(xref)).digest()
+    hashes[xref] = digest
+    return digest
+
+def get_canvas_pixels(config, size):
+    # Pixels of the page that are in memory at the same time
+    if is_banded_page(config, size):
+        return size[0] * config['band-height']
+    return size[0] * size[1]
+
+def estimate_page_memory(config, doc, kind, pixels, mode, images, image_infos, layout=None):
+    # Rough peak memory of a page in bytes. Pillow keeps images with more
+    # than one band with 4 bytes per pixel.
+    bytes_per_pixel = 4 if mode == 'RGB' else 1
+    if kind == 'extract':
+        # Largest image, decoded and converted
+        return max((image[2] * image[3] for image in images), default=0) * 4 * 2
+    elif kind in ('render', 'render-fallback'):
+        # Pixmap and the image copied from it
+        memory = pixels * (3 if mode == 'RGB' else 1) + pixels * bytes_per_pixel
+    else:
+        # Passthrough pages fall back to compositing when the overlay is not
+        # empty. Merged image, the decoded images with the clipping mask of
+        # one of them, and the overlay rendered with alpha and converted.
+        # Every image is decoded, pages written in bands only decode the
+        # images that overlap a band, see get_band_sources().
+        infos = [get_image_info(doc, image_infos, image[0]) for image in images]
+        image_memory = [info.width * info.height * (4 if get_image_colorspace(info) == 'RGB' else 1) for info in infos]
+        band_memory = [sum(image_memory)]
+        if layout is not None and is_banded_page(config, layout.size):
+            band_height = config['band-height']
+            positions = get_image_positions(layout)
+            band_memory = [sum(memory for memory, info, (_, y) in zip(image_memory, infos, positions)
+                               if y < top + band_height and y + info.height > top)
+                           for top in range(0, layout.size[1], band_height)]
+        largest = max(band_memory, default=0) + max((info.width * info.height for info in infos), default=0)
+        memory = pixels * bytes_per_pixel + largest + pixels * 4 * 2
+    if config['encode-processes']:
+        # Copy of the pixels handed to the encoder
+        memory += pixels * bytes_per_pixel
+    return memory
+
+def schedule_pages(config, plans):
+    # Largest pages first so that one huge page does not stall the end of the
+    # run, small pages grouped into chunks to save round trips to the workers.
+    # Returns lists of PagePlan. Archives are written in page order, so their
+    # pages are converted in order too.
+    if not config['archive']:
+        plans = sorted(plans, key=lambda plan: (-plan.pixels, plan.pagenum))
+    target = sum(plan.pixels for plan in plans) / (config['processes'] * 16)
+    chunks = []
+    chunk = []
+    cost = 0
+    for plan in plans:
+        chunk.append(plan)
+        cost += plan.pixels
+        if cost >= target or len(chunk) >= MAX_CHUNK_PAGES:
+            chunks.append(chunk)
+            chunk = []
+            cost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def print_plan(config, file, plans):
+    print(file)
+    for plan in plans:
+        print(f'  {str(plan.pagenum + 1).zfill(3)}  {plan.kind:<16}{plan.pixels / 1e6:8.1f} MP  {plan.memory / 2**20:8.0f} MB')
+    kinds = {}
+    for plan in plans:
+        count, pixels = kinds.get(plan.kind, (0, 0))
+        kinds[plan.kind] = (count + 1, pixels + plan.pixels)
+    for kind, (count, pixels) in kinds.items():
+        print(f'  {kind:<16}{count:6}頁{pixels / 1e6:10.1f} MP')
+    # Peak memory when the largest pages run at the same time
+    memory = sorted((plan.memory for plan in plans), reverse=True)[:config['processes']]
+    print(f'  共{len(plans)}頁，{sum(plan.pixels for plan in plans) / 1e6:.1f} MP，'
+          f'預估記憶體峰值{sum(memory) / 2**20:.0f} MB（{config["processes"]}個進程）')
+
+def get_page_options(config, kind, files):
+    options = {option: config[option] for option in PAGE_OPTIONS[kind]}
+    for file in files:
+        for option in FORMAT_OPTIONS.get(os.path.splitext(file['name'])[1], ()):
+            options[option] = config[option]
+    return options
+
+def get_manifest_name(shard):
+    if shard is None:
+        return MANIFEST_NAME
+    return f'pdf2img-manifest-{shard[0]}-of-{shard[1]}.jsonl'
+
+def is_manifest_name(name):
+    return name.startswith('pdf2img-manifest') and name.endswith('.jsonl')
+
+def read_manifest(output_dir):
+    # Records of every page by (pdf checksum, page number), oldest first,
+    # from the manifests of all shards
+    records = {}
+    try:
+        names = sorted(name for name in os.listdir(output_dir) if is_manifest_name(name))
+    except FileNotFoundError:
+        return records
+    for name in names:
+        with open(os.path.join(output_dir, name), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut off when the last run was killed
+                    continue
+                records.setdefault((record.get('source'), record['page']), []).append(record)
+    return records
+
+def find_done_record(config, output_dir, records, source, pagenum):
+    for record in reversed(records.get((source, pagenum + 1), [])):
+        if is_page_done(config, output_dir, record):
+            return record
+    return None
+
+def is_page_done(config, output_dir, record):
+    # The page was converted with the same options and its files are unchanged
+    if 'options' not in record or any(config.get(option) != value for option, value in record['options'].items()):
+        return False
+    for file in record['files']:
+        filename = os.path.join(output_dir, file['name'])
+        try:
+            if os.path.getsize(filename) != file['size'] or file_checksum(filename) != file['sha256']:
+                return False
+        except OSError:
+            return False
+    return True
+
+def merge_encoder_stats(stats, encoder_stats):
+    for name, stage in encoder_stats['stages'].items():
+        total = stats['stages'].setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'peak': 0})
+        total['wall'] += stage['wall']
+        total['cpu'] += stage['cpu']
+        total['peak'] = max(total['peak'], stage['peak'])
+    stats['encoder'] = {key: encoder_stats[key] for key in ('pid', 'wall', 'cpu', 'peak')}
+
+def merge_part_stats(stats, part_stats):
+    # Stages of the other parts of a split page are added to the first part
+    for name, stage in part_stats['stages'].items():
+        total = stats['stages'].setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'peak': 0})
+        total['wall'] += stage['wall']
+        total['cpu'] += stage['cpu']
+        total['peak'] = max(total['peak'], stage['peak'])
+    stats.setdefault('parts', []).append({key: part_stats[key] for key in ('pid', 'wall', 'cpu', 'peak')})
+
+def summarize_profile(pages, elapsed):
+    """pages is a list of (file, pagenum, stats) of the converted pages."""
+    stages = {}
+    busy = {}
+    for _, _, stats in pages:
+        for name, stage in stats['stages'].items():
+            total = stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'peak': 0})
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+            total['peak'] = max(total['peak'], stage['peak'])
+        for process in [stats, stats.get('encoder')] + stats.get('parts', []):
+            if process is not None:
+                busy[process['pid']] = busy.get(process['pid'], 0.0) + process['wall']
+    slowest = sorted(pages, key=lambda page: -page[2]['wall'])[:10]
+    return {'elapsed': elapsed,
+            'pages': len(pages),
+            'stages': stages,
+            'slowest': [{'file': file, 'page': pagenum + 1, 'path': stats['path'],
+                         'wall': stats['wall'], 'peak': stats['peak']} for file, pagenum, stats in slowest],
+            # Part of the time each process spent converting or encoding pages
+            'utilization': {str(pid): busy_time / elapsed if elapsed else 0.0 for pid, busy_time in busy.items()}}
+
+def write_profile(filename, pages, summary):
+    # CSV with one row for every stage of every page, otherwise JSON
+    if filename.lower().endswith('.csv'):
+        with open(filename, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'page', 'path', 'pixels', 'pid', 'stage', 'wall', 'cpu', 'peak'])
+            for file, pagenum, stats in pages:
+                for name, stage in stats['stages'].items():
+                    writer.writerow([file, pagenum + 1, stats['path'], stats['pixels'], stats['pid'],
+                                     name, stage['wall'], stage['cpu'], stage['peak']])
+                writer.writerow([file, pagenum + 1, stats['path'], stats['pixels'], stats['pid'],
+                                 'total', stats['wall'], stats['cpu'], stats['peak']])
+    else:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary,
+                       'pages': [dict(stats, file=file, page=pagenum + 1) for file, pagenum, stats in pages]},
+                      f, ensure_ascii=False, indent=1)
+
+def print_profile(summary):
+    print(f"共{summary['pages']}頁，耗時{summary['elapsed']:.1f}秒")
+    print('各階段時間（秒）及記憶體峰值：')
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall']):
+        print(f"  {name:<12}實際{stage['wall']:10.2f}  CPU{stage['cpu']:10.2f}  {stage['peak'] / 2**20:8.0f} MB")
+    print('最慢的頁面：')
+    for page in summary['slowest']:
+        print(f"  {page['file']} 第{page['page']}頁  {page['path']}  {page['wall']:.2f}秒  {page['peak'] / 2**20:.0f} MB")
+    print('進程使用率：')
+    for pid, utilization in summary['utilization'].items():
+        print(f'  {pid}  {utilization:.0%}')
+
+def get_archive_name(config, file, shard, pagenums, page_count):
+    # Shards and runs of some of the pages have their own archive, so they
+    # do not overwrite the archive of a complete run
+    name = os.path.splitext(os.path.basename(file))[0]
+    if shard is not None:
+        name += f'-{shard[0]}-of-{shard[1]}'
+    elif len(pagenums) < page_count:
+        name += f'-p{format_page_ranges(pagenums)}'
+    return f"{name}.{config['archive']}"
+
+def open_archive(config, filename):
+    if config['archive'] == 'tar':
+        return tarfile.open(filename, 'w')
+    # Images are already compressed
+    return zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED)
+
+def write_archive_file(archive, name, data):
+    if isinstance(archive, tarfile.TarFile):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        archive.addfile(info, BytesIO(data))
+    else:
+        archive.writestr(name, data)
+
+def format_page_ranges(pagenums):
+    # Sorted page numbers starting from 0 to '1-3,5'
+    ranges = []
+    for pagenum in pagenums:
+        if ranges and ranges[-1][1] == pagenum - 1:
+            ranges[-1][1] = pagenum
+        else:
+            ranges.append([pagenum, pagenum])
+    return ','.join(f'{first + 1}' if first == last else f'{first + 1}-{last + 1}' for first, last in ranges)
+
+def parse_page_ranges(ranges, page_count):
+    # '1-3,5,8-' to sorted page numbers starting from 0
+    pagenums = set()
+    for part in ranges.split(','):
+        start, separator, end = part.strip().partition('-')
+        first = int(start) if start else 1
+        if not separator:
+            last = first
+        else:
+            last = int(end) if end else page_count
+        pagenums.update(range(max(first, 1) - 1, min(last, page_count)))
+    return sorted(pagenums)
+
+def shard_pages(plans, shard):
+    # Longest processing time first: every page goes to the shard with the
+    # lowest cost so far. The same plans give the same shards on every machine.
+    index, shard_count = shard
+    costs = [0] * shard_count
+    shards = [[] for _ in range(shard_count)]
+    for plan in sorted(plans, key=lambda plan: (-plan.pixels, plan.pagenum)):
+        lowest = costs.index(min(costs))
+        shards[lowest].append(plan.pagenum)
+        costs[lowest] += plan.pixels
+    return sorted(shards[index - 1])
+
+def merge_manifests(config, file, output_dir, pagenums):
+    """Check that the shards together converted the pages of file and
+    collect their records in the manifest. Returns False if pages are missing.
+    """
+    source = file_checksum(file)
+    records = read_manifest(output_dir)
+    merged = {}
+    missing = []
+    for pagenum in pagenums:
+        record = find_done_record(config, output_dir, records, source, pagenum)
+        if record is None:
+            missing.append(pagenum + 1)
+        else:
+            merged[(source, pagenum + 1)] = record
+    if missing:
+        print(f"{file}：第{', '.join(str(pagenum) for pagenum in missing)}頁尚未轉換")
+        return False
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        for key, candidates in records.items():
+            record = merged.get(key, candidates[-1])
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f'{file}：{len(pagenums)}頁皆已轉換')
+    return True
+
+def convert_files(config, jobs, event, callback, shard=None):
+    """Convert the pages of several files on one pool of workers.
+
+    event is a multiprocessing.Event that stops the conversion when set.
+    jobs is an iterable of (file, output_dir, pagenums). It may yield None
+    when no job is waiting, the workers are then kept until it ends. With
+    shard (index, count), only the pages of pagenums that go to that shard
+    are converted, see shard_pages().
+    callback(file, pagenum, result)
+    is called in the calling thread for every finished page. Finished pages
+    are also recorded in the manifest of their output directory, and pages
+    recorded there are not converted again unless 'overwrite' is set.
+    With 'archive', the pages of every file are written into one archive in
+    the output directory instead, in page order.
+    """
+    def tasks():
+        nonlocal jobs_finished
+        for job in jobs:
+            if job is None:
+                yield None
+                continue
+            file, output_dir, selected = job
+            if output_dir not in manifests:
+                records[output_dir] = {} if config['overwrite'] else read_manifest(output_dir)
+                # Append, so the records of an interrupted run are kept, and
+                # the records of earlier files in this run
+                overwrite = config['overwrite'] and output_dir not in truncated
+                manifests[output_dir] = open(os.path.join(output_dir, get_manifest_name(shard)), 'w' if overwrite else 'a', encoding='utf-8')
+                truncated.add(output_dir)
+                unrecorded[output_dir] = 0
+            try:
+                sources[file] = file_checksum(file)
+                with fitz.open(file) as doc:
+                    page_count = doc.page_count
+                    render_zoom = get_render_zoom(config, doc)
+                    plans = None
+                    if shard is not None:
+                        # The whole selection is planned, so that every shard
+                        # agrees, and the plans of this shard are kept
+                        plans = plan_document(config, doc, selected, render_zoom)
+                        selected = shard_pages(plans, shard)
+                    pagenums = []
+                    for pagenum in selected:
+                        if config['archive']:
+                            # Every page goes into the new archive
+                            record = None
+                        else:
+                            record = find_done_record(config, output_dir, records[output_dir], sources[file], pagenum)
+                        if record is not None:
+                            callback(file, pagenum, record)
+                        else:
+                            pagenums.append(pagenum)
+                    if len(pagenums) < len(selected):
+                        print(f'{file}：略過{len(selected) - len(pagenums)}頁已轉換的頁面')
+                    if plans is None:
+                        plans = plan_document(config, doc, pagenums, render_zoom)
+                    else:
+                        remaining = set(pagenums)
+                        plans = [plan for plan in plans if plan.pagenum in remaining]
+                    references = find_image_references(doc, selected) if config['only-extract'] else {}
+                    keys = {}
+                    if config['dedupe'] and not config['only-extract']:
+                        keys = get_page_keys(config, doc, pagenums, render_zoom)
+            except Exception:
+                print(traceback.format_exc())
+                for pagenum in selected:
+                    callback(file, pagenum, None)
+                close_manifest(output_dir)
+                close_file(file)
+                continue
+            unrecorded[output_dir] += len(pagenums)
+            file_pages[file] = file_pages.get(file, 0) + len(pagenums)
+            close_manifest(output_dir)
+            close_file(file)
+            for plan in plans:
+                kinds[(file, plan.pagenum)] = plan.kind
+            if config['archive'] and pagenums:
+                name = get_archive_name(config, file, shard, selected, page_count)
+                archives[file] = {'archive': open_archive(config, os.path.join(output_dir, name)),
+                                  'name': name,
+                                  'pagenums': pagenums,
+                                  'next': 0,
+                                  'buffer': {}}
+            plans = [plan for plan in plans if not find_duplicate(file, plan.pagenum, output_dir, keys.get(plan.pagenum))]
+            for plans in schedule_pages(config, plans):
+                whole = []
+                for plan in plans:
+                    count = get_page_parts(config, plan)
+                    if count == 1:
+                        whole.append(plan)
+                        continue
+                    # Parts of a huge page are converted by several workers
+                    page_parts[(file, plan.pagenum)] = {}
+                    for index in range(count):
+                        yield Task(file, sources[file], [plan.pagenum], output_dir, {}, render_zoom, (index, count), plan.memory)
+                if not whole:
+                    continue
+                pagenums = [plan.pagenum for plan in whole]
+                # Pages of a chunk are converted one after another
+                yield Task(file, sources[file], pagenums, output_dir,
+                           {pagenum: references[pagenum] for pagenum in pagenums if pagenum in references},
+                           render_zoom, None, max(plan.memory for plan in whole))
+        jobs_finished = True
+
+    def close_manifest(output_dir):
+        # Closed when every page of the directory is recorded, so a long
+        # running service does not keep every manifest open
+        if not unrecorded[output_dir]:
+            manifests.pop(output_dir).close()
+            del records[output_dir]
+            del unrecorded[output_dir]
+
+    def close_file(file):
+        # Dropped when every page of the file is recorded, so a long running
+        # service does not keep the state of every page it has converted
+        if file_pages.get(file):
+            return
+        file_pages.pop(file, None)
+        sources.pop(file, None)
+        for key in [it for it in attempts if it[0] == file]:
+            del attempts[key]
+        for key in [key for key, entry in duplicates.items() if entry['file'] == file and entry['result'] is not None]:
+            del duplicates[key]
+
+    def find_duplicate(file, pagenum, output_dir, key):
+        # Pages that look the same as an earlier page are not converted,
+        # they are copied when that page is finished. Returns True if the
+        # page is left to an earlier page.
+        if key is None:
+            return False
+        entry = duplicates.get(key)
+        if entry is not None and entry['result'] is None:
+            entry['duplicates'].append((file, pagenum, output_dir))
+            return True
+        if entry is not None and not config['archive']:
+            original_pagenum, original_dir = entry['page']
+            if all(os.path.exists(os.path.join(original_dir, it['name'])) for it in entry['result']['files']):
+                try:
+                    copy = copy_page_result(entry['result'], original_pagenum, original_dir, pagenum, output_dir)
+                    copy['duplicate'] = entry['duplicate']
+                except OSError:
+                    print(traceback.format_exc())
+                    copy = None
+                output_page(file, pagenum, output_dir, copy)
+                return True
+        # The first page with this key, or the data of the earlier page is
+        # gone from memory into an archive
+        duplicates[key] = {'file': file, 'page': (pagenum, output_dir), 'result': None, 'duplicates': [],
+                           'duplicate': {'source': sources[file], 'page': pagenum + 1}}
+        page_keys[(file, pagenum)] = key
+        return False
+
+    def page_finished(file, pagenum, output_dir, result):
+        copies = []
+        key = page_keys.pop((file, pagenum), None)
+        if key is not None:
+            entry = duplicates[key]
+            for duplicate_file, duplicate_pagenum, duplicate_dir in entry['duplicates']:
+                copy = None
+                if result is not None:
+                    try:
+                        copy = copy_page_result(result, pagenum, output_dir, duplicate_pagenum, duplicate_dir)
+                        copy['duplicate'] = entry['duplicate']
+                    except OSError:
+                        print(traceback.format_exc())
+                copies.append((duplicate_file, duplicate_pagenum, duplicate_dir, copy))
+            if result is None:
+                del duplicates[key]
+            else:
+                entry['result'] = {'files': result['files']}
+                entry['duplicates'] = []
+        output_page(file, pagenum, output_dir, result)
+        for duplicate_file, duplicate_pagenum, duplicate_dir, copy in copies:
+            output_page(duplicate_file, duplicate_pagenum, duplicate_dir, copy)
+
+    def output_page(file, pagenum, output_dir, result):
+        if file in archives:
+            archive_page(file, pagenum, output_dir, result)
+        else:
+            record_page(file, pagenum, output_dir, result)
+
+    def archive_page(file, pagenum, output_dir, result):
+        # Pages that finish out of order wait in the buffer until the pages
+        # before them are written
+        nonlocal archive_size
+        writer = archives[file]
+        writer['buffer'][pagenum] = result
+        if result is not None:
+            archive_size += sum(len(data) for data in result['data'].values())
+        while writer['next'] < len(writer['pagenums']) and writer['pagenums'][writer['next']] in writer['buffer']:
+            pagenum = writer['pagenums'][writer['next']]
+            writer['next'] += 1
+            result = writer['buffer'].pop(pagenum)
+            if result is not None:
+                for name, data in result.pop('data').items():
+                    write_archive_file(writer['archive'], name, data)
+                    archive_size -= len(data)
+                result['archive'] = writer['name']
+            record_page(file, pagenum, output_dir, result)
+        if writer['next'] == len(writer['pagenums']):
+            writer['archive'].close()
+            del archives[file]
+
+    def record_page(file, pagenum, output_dir, result):
+        kind = kinds.pop((file, pagenum), None)
+        if result is not None:
+            record = {'page': pagenum + 1,
+                      'source': sources[file],
+                      'options': get_page_options(config, kind, result['files']),
+                      'files': result['files']}
+            if 'archive' in result:
+                record['archive'] = result['archive']
+            if result['references']:
+                record['references'] = {str(img_xref): owner + 1 for img_xref, owner in result['references'].items()}
+            if 'duplicate' in result:
+                record['duplicate'] = result['duplicate']
+            manifests[output_dir].write(json.dumps(record, ensure_ascii=False) + '\n')
+            manifests[output_dir].flush()
+        unrecorded[output_dir] -= 1
+        file_pages[file] -= 1
+        close_manifest(output_dir)
+        close_file(file)
+        callback(file, pagenum, result)
+
+    def encode_finished(file, pagenum, output_dir, result, output):
+        if output is None:
+            result = None
+        else:
+            result['files'] += output['files']
+            if 'data' in output:
+                result['data'].update(output['data'])
+            if 'stats' in output:
+                merge_encoder_stats(result['stats'], output['stats'])
+        page_finished(file, pagenum, output_dir, result)
+
+    def part_finished(task, result):
+        # The page is joined when all of its parts are finished
+        pagenum = task.pagenums[0]
+        parts = page_parts[(task.file, pagenum)]
+        parts[task.part[0]] = result
+        if len(parts) < task.part[1]:
+            return
+        del page_parts[(task.file, pagenum)]
+        if any(part is None for part in parts.values()):
+            page_finished(task.file, pagenum, task.output_dir, None)
+            return
+        try:
+            result = join_page_parts(config, task.output_dir, pagenum, [parts[index] for index in range(task.part[1])])
+        except Exception:
+            print(traceback.format_exc())
+            result = None
+        page_converted(task.file, pagenum, task.output_dir, result)
+
+    def page_converted(file, pagenum, output_dir, result):
+        # Pages that are returned unencoded go to the encoder processes
+        nonlocal encoding_size
+        if result is not None and 'image' in result:
+            image = result.pop('image')
+            future = encoder.submit(encode_image, config, *image)
+            encoding[future] = (file, pagenum, output_dir, result, image)
+            encoding_size += len(image[2])
+        else:
+            page_finished(file, pagenum, output_dir, result)
+
+    def chunk_finished(task, results):
+        if task.part is not None:
+            part_finished(task, results)
+            return
+        for pagenum, result in zip(task.pagenums, results):
+            page_converted(task.file, pagenum, task.output_dir, result)
+
+    def is_retried(task):
+        return (task.file, task.pagenums[0], task.part) in attempts
+
+    def is_last_attempt(task):
+        return attempts.get((task.file, task.pagenums[0], task.part), 0) >= MAX_RETRIES
+
+    def is_large(task):
+        return memory_limit and task.memory > memory_limit / config['processes']
+
+    def can_submit(task):
+        if not pending:
+            return True
+        # Pages that are retried for the last time after a process was
+        # killed run alone, so they cannot take other pages down with them
+        if is_last_attempt(task) or any(is_last_attempt(it) for it in pending.values()):
+            return False
+        if memory_limit and pending_memory + task.memory > memory_limit:
+            return False
+        # Large pages have their own lane, only one of them at a time
+        return not (is_large(task) and any(is_large(it) for it in pending.values()))
+
+    def retry_pages(task):
+        # Split the chunk, so pages that did not cause the failure are not
+        # retried together with the one that did
+        for pagenum in task.pagenums:
+            key = (task.file, pagenum, task.part)
+            attempts[key] = attempts.get(key, 0) + 1
+            if attempts[key] <= MAX_RETRIES:
+                references = {pagenum: task.references[pagenum]} if pagenum in task.references else {}
+                retry.append(Task(task.file, task.source, [pagenum], task.output_dir, references, task.render_zoom, task.part, task.memory))
+            elif task.part is not None:
+                part_finished(task, None)
+            else:
+                page_finished(task.file, pagenum, task.output_dir, None)
+
+    manifests = {}
+    # Pages of each output directory that are not recorded yet, and the
+    # directories whose manifest was truncated with 'overwrite'
+    unrecorded = {}
+    truncated = set()
+    # Set when jobs has ended
+    jobs_finished = False
+    # Pages by key for 'dedupe', and the keys of the pages being converted
+    duplicates = {}
+    page_keys = {}
+    # Results of the finished parts of split pages by (file, pagenum)
+    page_parts = {}
+    # Archives being written by file
+    archives = {}
+    # Size of the pages waiting to be written into the archives
+    archive_size = 0
+    # Records of earlier runs, checksums of the pdf files and kinds of pages,
+    # and the pages of each file that are not recorded yet
+    records = {}
+    sources = {}
+    kinds = {}
+    file_pages = {}
+    memory_limit = config['memory-limit'] * 2**20
+    processes = config['processes']
+    # Chunks submitted to the workers: future -> task
+    pending = {}
+    pending_memory = 0
+    # Pages waiting for the encoder processes, and the memory they hold
+    encoding = {}
+    encoding_size = 0
+    retry = []
+    attempts = {}
+    task_iter = tasks()
+    next_task = None
+    # Use ProcessPoolExecutor instead of multiprocessing.Pool
+    # to detect error of process killed due to low memory
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=convert_page_init, initargs=(event,))
+    # No encoder process is started unless 'encode-processes' is set or a
+    # page is split with 'split-pages'
+    encoder = ProcessPoolExecutor(max_workers=max(config['encode-processes'], 1), initializer=encode_image_init)
+    try:
+        # Only keep a few chunks queued, so pages of the next file are
+        # dispatched as soon as workers become idle near the end of a file.
+        # With a memory limit, every submitted chunk should be running.
+        max_pending = processes if memory_limit else processes * 2
+        while True:
+            while (len(pending) < max_pending and not event.is_set()
+                   and encoding_size < config['encode-memory'] * 2**20
+                   and (archive_size < config['archive-memory'] * 2**20 or retry)):
+                if next_task is None:
+                    next_task = retry.pop(0) if retry else next(task_iter, None)
+                if next_task is None or not can_submit(next_task):
+                    break
+                task = next_task
+                next_task = None
+                if task.part is not None:
+                    future = pool.submit(convert_page_part, config, task.file, task.source, task.pagenums[0], task.output_dir, task.render_zoom, task.part)
+                else:
+                    future = pool.submit(convert_pages, config, task.file, task.source, task.pagenums, task.output_dir, task.references, task.render_zoom)
+                pending[future] = task
+                pending_memory += task.memory
+            if not pending and not encoding:
+                if jobs_finished or event.is_set():
+                    break
+                # Waiting for new jobs
+                event.wait(JOB_POLL_INTERVAL)
+                continue
+            # Chunks given to a worker, only these are retried as attempts
+            # when a worker is killed
+            running = {future for future in pending if future.running()}
+            # Wake up for new jobs, while the workers are busy with old ones
+            done, _ = wait(list(pending) + list(encoding), timeout=None if jobs_finished else JOB_POLL_INTERVAL,
+                           return_when=FIRST_COMPLETED)
+            pool_broken = False
+            encoder_broken = False
+            for future in done:
+                if future in encoding:
+                    file, pagenum, output_dir, result, image = encoding[future]
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        encoder_broken = True
+                        continue
+                    del encoding[future]
+                    encoding_size -= len(image[2])
+                    encode_finished(file, pagenum, output_dir, result, future.result())
+                    continue
+                if isinstance(future.exception(), BrokenProcessPool):
+                    pool_broken = True
+                    continue
+                task = pending.pop(future)
+                pending_memory -= task.memory
+                chunk_finished(task, future.result())
+            if pool_broken:
+                # A worker was killed, probably because memory ran out. The
+                # chunks that were running are retried with fewer processes,
+                # only as many as processes are submitted until they are
+                # finished. Chunks that were only queued are submitted again.
+                pool.shutdown(wait=False)
+                processes = max(processes // 2, 1)
+                max_pending = processes
+                print(f'BrokenProcessPool: 可能記憶體不足，以{processes}個進程重試未完成的頁面')
+                for future, task in pending.items():
+                    if future.done() and future.exception() is None:
+                        chunk_finished(task, future.result())
+                    elif future in running:
+                        retry_pages(task)
+                    else:
+                        retry.append(task)
+                pending.clear()
+                pending_memory = 0
+                # Retried pages go first
+                if next_task is not None:
+                    retry.append(next_task)
+                    next_task = None
+                pool = ProcessPoolExecutor(max_workers=config['processes'], initializer=convert_page_init, initargs=(event,))
+            elif (processes < config['processes'] and not retry
+                  and not any(is_retried(it) for it in pending.values())
+                  and not (next_task is not None and is_retried(next_task))):
+                # The retried pages are finished
+                processes = config['processes']
+                max_pending = processes if memory_limit else processes * 2
+                print(f'已完成重試的頁面，恢復為{processes}個進程')
+            if encoder_broken:
+                encoder.shutdown(wait=False)
+                print('BrokenProcessPool: 可能記憶體不足，重新編碼未完成的頁面')
+                encoder = ProcessPoolExecutor(max_workers=max(config['encode-processes'], 1), initializer=encode_image_init)
+                for future, (file, pagenum, output_dir, result, image) in list(encoding.items()):
+                    del encoding[future]
+                    if future.done() and future.exception() is None:
+                        encoding_size -= len(image[2])
+                        encode_finished(file, pagenum, output_dir, result, future.result())
+                        continue
+                    attempts[(file, pagenum)] = attempts.get((file, pagenum), 0) + 1
+                    if attempts[(file, pagenum)] > MAX_RETRIES:
+                        encoding_size -= len(image[2])
+                        page_finished(file, pagenum, output_dir, None)
+                    else:
+                        encoding[encoder.submit(encode_image, config, *image)] = (file, pagenum, output_dir, result, image)
+    finally:
+        pool.shutdown()
+        encoder.shutdown()
+        for writer in archives.values():
+            writer['archive'].close()
+        for manifest in manifests.values():
+            manifest.close()
+
+def new_job(job_id, file, output_dir, ranges=None, priority=0):
+    # Progress of a conversion job, shared by the GUI and the service mode
+    return {'id': job_id,
+            'file': file,
+            'output_dir': output_dir,
+            'ranges': ranges,
+            'priority': priority,
+            'state': 'queued',
+            'pages': 0,
+            'finished': 0,
+            'failed': [],
+            'error': None,
+            'submitted': time.time(),
+            'started': None,
+            'ended': None}
+
+def start_job(job, page_count):
+    job['state'] = 'running'
+    job['pages'] = page_count
+    job['started'] = time.time()
+    if not page_count:
+        job['state'] = 'done'
+        job['ended'] = job['started']
+
+def finish_job_page(job, pagenum, result):
+    job['finished'] += 1
+    if result is None:
+        job['failed'].append(pagenum + 1)
+    if job['finished'] == job['pages']:
+        job['state'] = 'failed' if job['failed'] else 'done'
+        job['ended'] = time.time()
+
+def fail_job(job, error):
+    job['state'] = 'failed'
+    job['error'] = error
+    job['ended'] = time.time()
+
+def get_progress(jobs):
+    # Finished and total pages of the jobs
+    return sum(job['finished'] for job in jobs), sum(job['pages'] for job in jobs)
+
+def unique_files(files):
+    # Files given more than once are converted once, the state of a
+    # conversion is kept by file
+    seen = set()
+    unique = []
+    for file in files:
+        key = os.path.normcase(os.path.abspath(file))
+        if key not in seen:
+            seen.add(key)
+            unique.append(file)
+    return unique
+
+def get_output_dir(file):
+    if 'PDF2IMG_OUTPUT' in os.environ:
+        return os.path.join(os.environ['PDF2IMG_OUTPUT'], file + "-img")
+    return file + "-img"
+
+def serve(config, event, watch_dir, port):
+    """Convert jobs on one pool of workers until the event is set. The
+    workers and their caches stay warm between jobs.
+
+    Jobs are the pdf files put into watch_dir, and the jobs posted to
+    http://127.0.0.1:port/jobs as json: {"file": ..., "output_dir": ...,
+    "pages": "1-10", "priority": 0}, only file is required. Waiting jobs
+    with a higher priority start first. A file that has a waiting or running
+    job is answered with that job, or with 409 if the posted job differs.
+    GET /jobs and GET /jobs/<id> return the progress of the jobs.
+    """
+    # Imported here, only the service mode needs it
+    import http.server
+
+    lock = threading.Lock()
+    # Heap of (-priority, id, job) of the waiting jobs
+    waiting = []
+    jobs = {}
+    # Queued or running jobs by file, a file is converted by one job at a time
+    active = {}
+
+    def get_job_output_dir(file):
+        # The absolute path of the file would replace PDF2IMG_OUTPUT in
+        # os.path.join(), so it is made relative to watch_dir
+        if 'PDF2IMG_OUTPUT' not in os.environ:
+            return file + "-img"
+        name = os.path.basename(file)
+        if watch_dir:
+            try:
+                relative = os.path.relpath(file, os.path.abspath(watch_dir))
+            except ValueError:
+                # On another drive
+                relative = os.pardir
+            if not relative.startswith(os.pardir):
+                name = relative
+        return get_output_dir(name)
+
+    def submit(file, output_dir=None, ranges=None, priority=0):
+        # Returns the job and whether it is new. A file that has a queued or
+        # running job is not queued again, the state of a conversion is kept
+        # by file.
+        file = os.path.abspath(file)
+        with lock:
+            if file in active:
+                return active[file], False
+            job = new_job(len(jobs) + 1, file, output_dir or get_job_output_dir(file), ranges, priority)
+            jobs[job['id']] = job
+            active[file] = job
+            heapq.heappush(waiting, (-priority, job['id'], job))
+        print(f"{file}：加入佇列（#{job['id']}）")
+        return job, True
+
+    def next_jobs():
+        # Jobs for convert_files(), None while no job is waiting
+        while not event.is_set():
+            with lock:
+                job = heapq.heappop(waiting)[2] if waiting else None
+            if job is None:
+                yield None
+                continue
+            try:
+                with fitz.open(job['file']) as doc:
+                    if job['ranges']:
+                        pagenums = parse_page_ranges(job['ranges'], doc.page_count)
+                    else:
+                        pagenums = list(range(doc.page_count))
+                os.makedirs(job['output_dir'], exist_ok=True)
+            except Exception as e:
+                print(f"{job['file']}：無法開啟檔案")
+                with lock:
+                    fail_job(job, str(e))
+                    del active[job['file']]
+                continue
+            with lock:
+                start_job(job, len(pagenums))
+                if job['state'] != 'running':
+                    del active[job['file']]
+            yield job['file'], job['output_dir'], pagenums
+
+    def page_finished(file, pagenum, result):
+        if result is None and not event.is_set():
+            print(f'{file}：第{pagenum + 1}頁轉換失敗')
+        with lock:
+            job = active[file]
+            finish_job_page(job, pagenum, result)
+            if job['state'] == 'running':
+                return
+            del active[file]
+        print(f"{file}：轉換完成（#{job['id']}，{job['pages'] - len(job['failed'])}/{job['pages']}頁）")
+
+    def watch():
+        # A file is queued when its size and time stop changing between two
+        # scans, so files that are still being written are left alone
+        scanned = {}
+        queued = {}
+        while not event.wait(WATCH_INTERVAL):
+            try:
+                names = sorted(os.listdir(watch_dir))
+            except OSError:
+                continue
+            for name in names:
+                if not name.lower().endswith('.pdf'):
+                    continue
+                file = os.path.join(watch_dir, name)
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                version = (stat.st_size, stat.st_mtime)
+                if scanned.get(file) == version and queued.get(file) != version:
+                    submit(file)
+                    queued[file] = version
+                scanned[file] = version
+
+    class JobHandler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with lock:
+                if self.path == '/jobs':
+                    data = list(jobs.values())
+                elif self.path.startswith('/jobs/') and self.path[6:].isdigit() and int(self.path[6:]) in jobs:
+                    data = jobs[int(self.path[6:])]
+                else:
+                    data = None
+                if data is not None:
+                    data = json.loads(json.dumps(data))
+            if data is None:
+                self.send_json(404, {'error': '找不到工作'})
+            else:
+                self.send_json(200, data)
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self.send_json(404, {'error': '找不到工作'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                file = request['file']
+                priority = int(request.get('priority', 0))
+                ranges = request.get('pages')
+                if ranges:
+                    parse_page_ranges(ranges, 1)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.send_json(400, {'error': '工作格式錯誤'})
+                return
+            if not isinstance(file, str) or not os.path.isfile(file):
+                self.send_json(400, {'error': '找不到檔案'})
+                return
+            job, created = submit(file, request.get('output_dir'), ranges, priority)
+            with lock:
+                data = json.loads(json.dumps(job))
+            if created:
+                self.send_json(201, data)
+            elif (os.path.abspath(data['output_dir']) == os.path.abspath(request.get('output_dir') or get_job_output_dir(data['file']))
+                  and data['ranges'] == ranges and data['priority'] == priority):
+                # The same job again
+                self.send_json(200, data)
+            else:
+                self.send_json(409, {'error': '此檔案已有未完成的工作，完成後才能再加入不同的工作', 'job': data})
+
+        def log_message(self, format, *args):
+            pass
+
+    threads = []
+    if watch_dir:
+        threads.append(threading.Thread(target=watch, daemon=True))
+        print(f'監看資料夾：{watch_dir}')
+    server = None
+    if port:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), JobHandler)
+        threads.append(threading.Thread(target=server.serve_forever, daemon=True))
+        print(f'接受工作：http://127.0.0.1:{port}/jobs')
+    for thread in threads:
+        thread.start()
+    try:
+        convert_files(config, next_jobs(), event, page_finished)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
 
 def gui(config):
+    # Imported here, so the command line does not load tkinter
+    import tkinter
+    import tkinter.filedialog
+    import tkinter.messagebox
+    from tkinter import ttk
+
     def open_pdf_file():
         name = tkinter.filedialog.askopenfilename()
         if name:
@@ -431,7 +2671,7 @@ def gui(config):
     def convert_thread_wrapper():
         # Create wrapper for updating UI after conversion finishes
         file = pdf_file.get('1.0' ,'end-1c')
-        convert_thread(file)
+        convert_thread([file])
         if event.is_set():
             event.clear()
         button_convert.config(state='normal')
@@ -450,8 +2690,7 @@ def gui(config):
 
     def convert_multiple_thread_wrapper(filenames):
         # Create wrapper for updating UI after conversion finishes
-        for file in filenames:
-            convert_thread(file)
+        convert_thread(filenames)
         if event.is_set():
             event.clear()
         button_convert.config(state='normal')
@@ -459,19 +2698,27 @@ def gui(config):
         button_stop.config(state='disabled')
         root.title('pdf2img')
 
-    def convert_thread(file):
-        if not file:
-            return
-        try:
-            with fitz.open(file) as doc:
-                page_count = doc.page_count
-        except:
-            tkinter.messagebox.showinfo(message='無法開啟檔案')
+    def convert_thread(filenames):
+        jobs = []
+        progress = {}
+        for file in unique_files(filenames):
+            if not file:
+                continue
+            try:
+                with fitz.open(file) as doc:
+                    page_count = doc.page_count
+            except:
+                tkinter.messagebox.showinfo(message=f'無法開啟檔案：{file}' if len(filenames) > 1 else '無法開啟檔案')
+                continue
+            output_dir = output_dir_text.get('1.0', 'end-1c')
+            if not output_dir:
+                output_dir = file + "-img"
+            os.makedirs(output_dir, exist_ok=True)
+            jobs.append((file, output_dir, range(page_count)))
+            progress[file] = new_job(len(progress) + 1, file, output_dir)
+            start_job(progress[file], page_count)
+        if not jobs:
             return
-        output_dir = output_dir_text.get('1.0', 'end-1c')
-        if not output_dir:
-            output_dir = file + "-img"
-        os.makedirs(output_dir, exist_ok=True)
         config['processes'] = processes.get()
         config['only-extract'] = only_extract.get()
         config['original-only'] = original_only.get()
@@ -481,28 +2728,30 @@ def gui(config):
         config['prefer-mono'] = prefer_mono.get()
         config['save-jxl'] = save_jxl.get()
         config['save-png'] = save_png.get()
-        failed_page = []
-        finished_page_count = 0
-        # Use ProcessPoolExecutor instead of multiprocessing.Pool
-        # to detect error of process killed due to low memory
-        with ProcessPoolExecutor(max_workers=config['processes'], initializer=convert_page_init,
-                                 initargs=(file,)) as pool:
-            try:
-                for idx, result in enumerate(pool.map(convert_page, repeat(config), range(page_count), repeat(output_dir), repeat(event))):
-                    finished_page_count += 1
-                    root.title(f'pdf2img ({finished_page_count}/{page_count})')
-                    if result != 1:
-                        failed_page.append(str(idx + 1))
-            except BrokenProcessPool:
-                tkinter.messagebox.showinfo(message='BrokenProcessPool: 可能記憶體不足')
-                return
+        config['passthrough-jpeg'] = passthrough_jpeg.get()
+        config['overwrite'] = overwrite.get()
 
-        if not event.is_set() and failed_page:
-            message = f"第{', '.join(failed_page)}頁轉換失敗"
-            tkinter.messagebox.showinfo(message=message)
+        def page_finished(file, pagenum, result):
+            finish_job_page(progress[file], pagenum, result)
+            finished_page_count, page_count = get_progress(progress.values())
+            root.title(f'pdf2img ({finished_page_count}/{page_count})')
 
-    manager = multiprocessing.Manager()
-    event = manager.Event()
+        try:
+            convert_files(config, jobs, event, page_finished)
+        except BrokenProcessPool:
+            tkinter.messagebox.showinfo(message='BrokenProcessPool: 可能記憶體不足')
+            return
+
+        if not event.is_set():
+            for file, job in progress.items():
+                if not job['failed']:
+                    continue
+                message = f"第{', '.join(str(pagenum) for pagenum in sorted(job['failed']))}頁轉換失敗"
+                if len(jobs) > 1:
+                    message = f'{file}：{message}'
+                tkinter.messagebox.showinfo(message=message)
+
+    event = multiprocessing.Event()
     root = tkinter.Tk()
     root.title('pdf2img')
     frame = tkinter.Frame(root)
@@ -517,6 +2766,8 @@ def gui(config):
     prefer_mono = tkinter.BooleanVar(value=config['prefer-mono'])
     save_jxl = tkinter.BooleanVar(value=config['save-jxl'])
     save_png = tkinter.BooleanVar(value=config['save-png'])
+    passthrough_jpeg = tkinter.BooleanVar(value=config['passthrough-jpeg'])
+    overwrite = tkinter.BooleanVar(value=config['overwrite'])
 
     ttk.Button(frame, text="要轉換的PDF檔", command=open_pdf_file).grid(sticky='w', column=0, row=0)
     pdf_file = tkinter.Text(frame, height=1)
@@ -542,50 +2793,127 @@ def gui(config):
     ttk.Checkbutton(frame,variable=save_jxl).grid(sticky='w', column=1, row=9)
     ttk.Label(frame, text='以png格式儲存').grid(sticky='w', column=0, row=10)
     ttk.Checkbutton(frame,variable=save_png).grid(sticky='w', column=1, row=10)
+    ttk.Label(frame, text='若頁面只有一張完整的jpeg圖片，直接輸出原圖').grid(sticky='w', column=0, row=11)
+    ttk.Checkbutton(frame,variable=passthrough_jpeg).grid(sticky='w', column=1, row=11)
+    ttk.Label(frame, text='重新轉換已轉換的頁面').grid(sticky='w', column=0, row=12)
+    ttk.Checkbutton(frame,variable=overwrite).grid(sticky='w', column=1, row=12)
     frame2 = tkinter.Frame(frame)
-    frame2.grid(sticky='w', column=0, row=11, pady=(10, 0))
+    frame2.grid(sticky='w', column=0, row=13, pady=(10, 0))
     button_convert = ttk.Button(frame2, text="轉換", command=convert)
     button_convert.grid(sticky='w', column=0, row=0, pady=(10, 0))
     button_convert_multiple = ttk.Button(frame2, text="多檔轉換", command=convert_multiple)
     button_convert_multiple.grid(sticky='w', column=1, row=0, pady=(10, 0), padx=10)
     button_stop = ttk.Button(frame, text="停止", command=event.set, state='disabled')
-    button_stop.grid(sticky='w', column=1, row=11, pady=(10, 0))
+    button_stop.grid(sticky='w', column=1, row=13, pady=(10, 0))
     root.mainloop()
 
 def interrupt(signum, frame, event):
     print('收到中斷訊號，將結束程式')
-    event.set()
+    # Set from another thread, the interrupted code may hold the lock of the event
+    threading.Thread(target=event.set).start()
 
 def main():
     # Disable DecompressionBombWarning
     Image.MAX_IMAGE_PIXELS = None
     config = read_config()
 
-    if len(sys.argv) == 1:
+    parser = argparse.ArgumentParser(description='將PDF轉換為圖片')
+    parser.add_argument('files', nargs='*', help='要轉換的PDF檔')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='只分析每頁的轉換方式，並估計像素數及記憶體用量，不進行轉換')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='重新轉換已轉換的頁面')
+    parser.add_argument('--archive', choices=ARCHIVE_FORMATS,
+                        help='將圖片依頁面順序直接寫入壓縮檔，不輸出個別檔案')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='記錄每頁各階段的時間及記憶體用量，寫入JSON檔（副檔名為.csv時寫入CSV檔）')
+    parser.add_argument('--pages',
+                        help='只轉換指定的頁面，例如 1-10,15,20-')
+    parser.add_argument('--shard',
+                        help='分成n份時只轉換第i份（i/n），依預估的轉換成本平均分配頁面，供多台電腦轉換同一個PDF檔到同一個輸出資料夾')
+    parser.add_argument('--merge', action='store_true',
+                        help='檢查各份轉換結果是否涵蓋所有頁面，並合併各份的紀錄')
+    parser.add_argument('--watch', metavar='DIR',
+                        help='服務模式：持續監看資料夾，轉換放入的PDF檔')
+    parser.add_argument('--port', type=int,
+                        help='服務模式：在127.0.0.1的此連接埠接受HTTP工作（POST /jobs）並回報進度（GET /jobs）')
+    args = parser.parse_args()
+    if args.overwrite:
+        config['overwrite'] = True
+    if args.archive:
+        config['archive'] = args.archive
+    if args.profile:
+        config['profile'] = True
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(int(number) for number in args.shard.split('/'))
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+            parser.error(f'--shard格式錯誤：{args.shard}')
+
+    if args.watch or args.port:
+        event = multiprocessing.Event()
+        signal.signal(signal.SIGINT, lambda signum, frame: interrupt(signum, frame, event))
+        serve(config, event, args.watch, args.port)
+        sys.exit(0)
+
+    if not args.files:
         gui(config)
         sys.exit(0)
 
-    manager = multiprocessing.Manager()
-    event = manager.Event()
+    jobs = []
+    for file in unique_files(args.files):
+        output_dir = get_output_dir(file)
+        with fitz.open(file) as doc:
+            if args.pages:
+                try:
+                    pagenums = parse_page_ranges(args.pages, doc.page_count)
+                except ValueError:
+                    parser.error(f'--pages格式錯誤：{args.pages}')
+            else:
+                pagenums = list(range(doc.page_count))
+            if args.dry_run:
+                plans = plan_document(config, doc, pagenums)
+                if shard is not None and not args.merge:
+                    selected = shard_pages(plans, shard)
+                    plans = [plan for plan in plans if plan.pagenum in selected]
+                print_plan(config, file, plans)
+                continue
+        jobs.append((file, output_dir, pagenums))
+    if args.dry_run:
+        return
+
+    if args.merge:
+        complete = True
+        for file, output_dir, pagenums in jobs:
+            complete = merge_manifests(config, file, output_dir, pagenums) and complete
+        sys.exit(0 if complete else 1)
+
+    event = multiprocessing.Event()
     signal.signal(signal.SIGINT, lambda signum, frame: interrupt(signum, frame, event))
 
-    for file in sys.argv[1:]:
-        if event.is_set():
-            break
-        if 'PDF2IMG_OUTPUT' in os.environ:
-            output_dir = os.path.join(os.environ['PDF2IMG_OUTPUT'], file + "-img")
-        else:
-            output_dir = file + "-img"
+    for _, output_dir, _ in jobs:
         os.makedirs(output_dir, exist_ok=True)
-        with fitz.open(file) as doc:
-            page_count = doc.page_count
-
-        # Use ProcessPoolExecutor instead of multiprocessing.Pool
-        # to detect error of process killed due to low memory
-        with ProcessPoolExecutor(max_workers=config['processes'], initializer=convert_page_init, initargs=(file,)) as pool:
-            for idx, result in enumerate(pool.map(convert_page, repeat(config), range(page_count), repeat(output_dir), repeat(event))):
-                if result != 1:
-                    print(f'第{idx + 1}頁轉換失敗')
+
+    profile_pages = []
+
+    def page_finished(file, pagenum, result):
+        if result is None and not event.is_set():
+            if len(jobs) > 1:
+                print(f'{file}：第{pagenum + 1}頁轉換失敗')
+            else:
+                print(f'第{pagenum + 1}頁轉換失敗')
+        if result is not None and 'stats' in result:
+            profile_pages.append((file, pagenum, result['stats']))
+
+    start = time.perf_counter()
+    convert_files(config, jobs, event, page_finished, shard)
+    if args.profile:
+        summary = summarize_profile(profile_pages, time.perf_counter() - start)
+        write_profile(args.profile, profile_pages, summary)
+        print_profile(summary)
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()